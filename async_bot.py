@@ -0,0 +1,600 @@
+import asyncio
+import logging
+import os
+import weakref
+from dataclasses import replace
+from functools import partial
+
+import aiohttp
+import redis.asyncio
+from dotenv import load_dotenv
+from telegram.error import RetryAfter, TelegramError
+
+from async_moltin_api import AsyncMoltinClient
+from breakers import CircuitOpenError
+from caches import AsyncStaleWhileRevalidate, LRUCache
+from deadlines import UPDATE_BUDGET
+from delivery_zones import DeliveryZones
+from geocoding import AsyncGeocodingCache
+from invalidation import listen_invalidations
+from jobs import JobScheduler
+from orders import Order, build_order
+from pizzerias import PizzeriaRegistry
+from screens import API_METHODS, plan_screen
+from sessions import AsyncSessionStore
+from tg_bot import (
+    CATALOG_TTL, FOLLOW_UP_DELAY, FOLLOW_UP_SEND_TIMEOUT, PIZZERIAS_TTL,
+    PRODUCT_CARDS_MAXSIZE, connect_redis,
+    get_delivery_terms, get_description_markup, get_follow_up_text,
+    get_invoice_prices, get_location_markup, get_menu_page,
+    get_no_courier_screen, get_order_text, get_pickup_text,
+    get_product_text, get_unavailable_text, get_unknown_address_text,
+    is_card_stale, render_cart, render_catalog, render_product_card,
+    schedule_customer_entry
+)
+from webhook import get_chat_id
+
+TELEGRAM_API_URL = 'https://api.telegram.org'
+
+logger = logging.getLogger(__name__)
+
+background_tasks = set()
+
+
+def run_in_background(coroutine):
+    """
+    Цикл событий держит на задачи лишь слабые ссылки, поэтому задача
+    без ссылки может пропасть, не доработав.
+    """
+    task = asyncio.create_task(coroutine)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+def run_on_loop(loop, coroutine_function, timeout):
+    """
+    Обработчик для JobScheduler: задачи выполняются в его потоках,
+    а корутина — в цикле событий бота; поток ждёт её результата.
+    """
+    def handle(payload):
+        asyncio.run_coroutine_threadsafe(
+            coroutine_function(payload),
+            loop
+        ).result(timeout)
+
+    return handle
+
+
+def to_api_value(value):
+    if isinstance(value, list):
+        return [to_api_value(item) for item in value]
+    if hasattr(value, 'to_dict'):
+        return value.to_dict()
+    return value
+
+
+class AsyncTelegramBot:
+    """Вызовы Bot API через общую aiohttp-сессию."""
+
+    def __init__(self, http_session, token, base_url=TELEGRAM_API_URL):
+        self.http_session = http_session
+        self.url = f'{base_url}/bot{token}'
+
+    async def call(self, method, request_timeout=10, **params):
+        params = {
+            key: to_api_value(value)
+            for key, value in params.items() if value is not None
+        }
+        async with self.http_session.post(
+            f'{self.url}/{method}',
+            json=params,
+            timeout=aiohttp.ClientTimeout(total=request_timeout)
+        ) as response:
+            decoded_response = await response.json()
+        if decoded_response['ok']:
+            return decoded_response['result']
+        retry_after = decoded_response.get('parameters', {}).get('retry_after')
+        if retry_after:
+            raise RetryAfter(retry_after)
+        raise TelegramError(decoded_response.get('description'))
+
+    async def get_updates(self, offset, timeout=30):
+        return await self.call(
+            'getUpdates',
+            request_timeout=timeout + 10,
+            offset=offset,
+            timeout=timeout
+        )
+
+
+class AsyncContext:
+    def __init__(self, bot, bot_data, chat_id, session):
+        self.bot = bot
+        self.bot_data = bot_data
+        self.chat_id = chat_id
+        self.session = session
+
+
+async def show_screen(update, context, text, reply_markup=None, photo=None,
+                      photo_key=None):
+    query = update.get('callback_query')
+    message = query and query.get('message')
+    calls, screen = plan_screen(
+        context.session.get('screen'),
+        context.chat_id,
+        message and message['message_id'],
+        message and ('photo' if 'photo' in message else 'text'),
+        text,
+        reply_markup,
+        photo,
+        photo_key
+    )
+    results = await asyncio.gather(*(
+        context.bot.call(API_METHODS[method], **kwargs)
+        for method, kwargs in calls
+    ))
+    if not calls and query:
+        await context.bot.call('answerCallbackQuery',
+                               callback_query_id=query['id'])
+    shown_message = results[0] if results else None
+    if screen['message_id'] is None and shown_message:
+        screen['message_id'] = shown_message['message_id']
+    context.session['screen'] = screen
+    return shown_message
+
+
+async def start(update, context):
+    catalog = await context.bot_data['catalog'].get()
+    await show_screen(
+        update, context, 'Выберите продукт:', catalog['pages'][0]
+    )
+    return 'HANDLE_MENU'
+
+
+async def load_product_card(context, product_id):
+    moltin = context.bot_data['moltin']
+    catalog = await context.bot_data['catalog'].get()
+    main_image = next(
+        (
+            product['relationships'].get('main_image')
+            for product in catalog['products']
+            if product['id'] == product_id
+            and 'relationships' in product
+        ),
+        None
+    )
+    if main_image:
+        product, image_url = await asyncio.gather(
+            moltin.get_product_by_id(product_id),
+            moltin.get_img_url(main_image['data']['id'])
+        )
+    else:
+        product = await moltin.get_product_by_id(product_id)
+        img_id = product['data']['relationships']['main_image']['data']['id']
+        image_url = await moltin.get_img_url(img_id)
+    return render_product_card(product['data'], image_url)
+
+
+async def handle_menu(update, context):
+    query = update['callback_query']
+    menu_page = get_menu_page(query['data'])
+    if menu_page is not None:
+        catalog = await context.bot_data['catalog'].get()
+        pages = catalog['pages']
+        await show_screen(
+            update,
+            context,
+            'Выберите продукт:',
+            pages[min(menu_page, len(pages) - 1)]
+        )
+        return 'HANDLE_MENU'
+    product_id = query['data']
+    context.session['product_id'] = product_id
+    product_cards = context.bot_data['product_cards']
+    card = product_cards.get(product_id)
+    if card is None or is_card_stale(card, context.bot_data['catalog'].ttl):
+        try:
+            fresh_card = await load_product_card(context, product_id)
+        except Exception:
+            if card is None:
+                raise
+            logger.warning('Показываю старую карточку товара %s', product_id)
+        else:
+            card = fresh_card
+            product_cards.set(product_id, card)
+
+    message = await show_screen(
+        update,
+        context,
+        get_product_text(card),
+        get_description_markup(),
+        photo=card['file_id'] or card['image_url'],
+        photo_key=card['image_url']
+    )
+    if isinstance(message, dict) and 'photo' in message:
+        card['file_id'] = message['photo'][-1]['file_id']
+    return 'HANDLE_DESCRIPTION'
+
+
+async def handle_description(update, context):
+    query = update['callback_query']
+    if query['data'] == 'back':
+        return await start(update, context)
+    if query['data'] == 'cart':
+        return 'HANDLE_CART'
+    await asyncio.gather(
+        context.bot_data['moltin'].add_product_to_cart(
+            context.chat_id, context.session['product_id'], 1
+        ),
+        context.bot.call('answerCallbackQuery', callback_query_id=query['id'])
+    )
+    return 'HANDLE_DESCRIPTION'
+
+
+async def send_cart_contents(update, context, cart_products):
+    message_text, reply_markup = render_cart(cart_products)
+    await show_screen(update, context, message_text, reply_markup)
+
+
+async def handle_cart(update, context):
+    query = update['callback_query']
+    moltin = context.bot_data['moltin']
+    if query['data'] == 'cart':
+        cart_products = await moltin.get_cart_products(context.chat_id)
+    elif query['data'] == 'payment':
+        cart_products = await moltin.get_cart_products(context.chat_id)
+        context.session['order'] = build_order(cart_products).to_dict()
+        return await handle_location_waiting(update, context)
+    else:
+        cart_products = await moltin.remove_product_from_cart(
+            context.chat_id, query['data']
+        )
+    await send_cart_contents(update, context, cart_products)
+    return 'HANDLE_CART'
+
+
+async def handle_location_waiting(update, context):
+    message = update.get('message')
+    if message and 'location' in message:
+        coords = (
+            message['location']['latitude'],
+            message['location']['longitude']
+        )
+        return await send_delivery_terms(update, context, coords)
+    if message:
+        geocoder = context.bot_data['geocoder']
+        coords = await geocoder.fetch_coordinates(message.get('text', ''))
+        if coords:
+            return await send_delivery_terms(update, context, coords)
+        await show_screen(
+            update,
+            context,
+            get_unknown_address_text(),
+            get_location_markup()
+        )
+        return 'LOCATION_WAITING'
+    await show_screen(
+        update,
+        context,
+        'Хорошо, пришлите нам Ваш адрес текстом или геолокацию.',
+        get_location_markup()
+    )
+    return 'LOCATION_WAITING'
+
+
+async def send_delivery_terms(update, context, coords):
+    lat, lon = coords
+    pizzeria_registry, _ = await asyncio.gather(
+        context.bot_data['pizzerias'].get(),
+        asyncio.to_thread(
+            schedule_customer_entry, context, context.chat_id, lat, lon
+        )
+    )
+    distance_to_customer, pizzeria = pizzeria_registry.find_nearest(coords)
+    nearest_pizzeria = {
+        'id': pizzeria['id'],
+        'address': pizzeria['address'],
+        'distance': distance_to_customer,
+    }
+    context.session['customer_coords'] = coords
+    if 'order' not in context.session:
+        # Снимка нет у чатов, начавших оформление до его появления.
+        cart_products = await context.bot_data['moltin'].get_cart_products(
+            context.chat_id
+        )
+        context.session['order'] = build_order(cart_products).to_dict()
+    context.session['order'] = replace(
+        Order.from_dict(context.session['order']),
+        customer_coords=tuple(coords),
+        pizzeria_id=nearest_pizzeria['id'],
+        pizzeria_address=nearest_pizzeria['address'],
+        distance=nearest_pizzeria['distance'],
+    ).to_dict()
+
+    text, reply_markup = get_delivery_terms(nearest_pizzeria)
+    await show_screen(update, context, text, reply_markup)
+    return 'HANDLE_SHIPPING_METHOD'
+
+
+async def write_customer_entry(moltin, payload):
+    await moltin.create_customer_entry(
+        payload['chat_id'],
+        payload['lat'],
+        payload['lon']
+    )
+
+
+async def write_to_customer(bot, payload):
+    await bot.call(
+        'sendMessage',
+        chat_id=payload['chat_id'],
+        text=get_follow_up_text()
+    )
+
+
+async def handle_shipping_method(update, context):
+    query = update['callback_query']
+    if context.session.get('order', {}).get('pizzeria_id') is None:
+        # Оформление началось до появления снимков заказа: пиццерию
+        # выбираем заново.
+        if 'customer_coords' in context.session:
+            return await send_delivery_terms(
+                update, context, context.session['customer_coords']
+            )
+        return await handle_location_waiting(update, context)
+    order = Order.from_dict(context.session['order'])
+    if query['data'] == 'pickup':
+        await context.bot.call(
+            'sendMessage',
+            chat_id=context.chat_id,
+            text=get_pickup_text(order.pizzeria_address)
+        )
+        return None
+
+    pizzeria_registry = await context.bot_data['pizzerias'].get()
+    courier_id = pizzeria_registry.get_courier_id(order.pizzeria_id)
+    if courier_id is None:
+        logger.error('У пиццерии %s нет курьера', order.pizzeria_id)
+        await show_screen(update, context, *get_no_courier_screen())
+        return 'HANDLE_SHIPPING_METHOD'
+    await show_screen(
+        update, context, 'После оплаты заказ будет передан курьеру'
+    )
+    order = replace(order, courier_id=courier_id)
+    context.session['order'] = order.to_dict()
+    await asyncio.gather(
+        context.bot.call(
+            'sendMessage',
+            chat_id=order.courier_id,
+            text=get_order_text(order)
+        ),
+        context.bot.call(
+            'sendInvoice',
+            chat_id=context.chat_id,
+            title='Заказ',
+            description='Описание платежа',
+            payload='Custom-Payload',
+            provider_token=context.bot_data['payment_token'],
+            currency=order.currency,
+            prices=get_invoice_prices(order)
+        )
+    )
+    await asyncio.to_thread(
+        context.bot_data['jobs'].schedule,
+        'write_to_customer',
+        {'chat_id': context.chat_id},
+        FOLLOW_UP_DELAY,
+        idempotency_key=(
+            f'follow-up:{context.chat_id}:{query["message"]["message_id"]}'
+        )
+    )
+    return None
+
+
+async def precheckout_callback(update, bot):
+    query = update['pre_checkout_query']
+    if query['invoice_payload'] != 'Custom-Payload':
+        await bot.call(
+            'answerPreCheckoutQuery',
+            pre_checkout_query_id=query['id'],
+            ok=False,
+            error_message='Something went wrong...'
+        )
+        return
+    await asyncio.gather(
+        bot.call(
+            'answerPreCheckoutQuery',
+            pre_checkout_query_id=query['id'],
+            ok=True
+        ),
+        bot.call(
+            'sendMessage',
+            chat_id=query['from']['id'],
+            text='Заказ передан курьеру, ожидайте'
+        )
+    )
+
+
+async def handle_users_reply(update, bot, bot_data):
+    """
+    Асинхронный аналог tg_bot.handle_users_reply: получает стейт
+    пользователя и его сессию, запускает хэндлер и сохраняет результат.
+    """
+    if 'pre_checkout_query' in update:
+        await precheckout_callback(update, bot)
+        return
+    if 'message' in update:
+        user_reply = update['message'].get('text')
+    elif 'callback_query' in update:
+        user_reply = update['callback_query']['data']
+    else:
+        return
+    chat_id = get_chat_id(update)
+
+    session_store = bot_data['sessions']
+    stored_state, session = await session_store.load(chat_id)
+    if user_reply == '/start':
+        user_state = 'START'
+    elif user_reply == 'cart':
+        user_state = 'HANDLE_CART'
+    elif 'callback_query' in update \
+            and get_menu_page(user_reply) is not None:
+        user_state = 'HANDLE_MENU'
+    else:
+        user_state = stored_state or 'START'
+    states_functions = {
+        'START': start,
+        'HANDLE_MENU': handle_menu,
+        'HANDLE_DESCRIPTION': handle_description,
+        'HANDLE_CART': handle_cart,
+        'LOCATION_WAITING': handle_location_waiting,
+        'HANDLE_SHIPPING_METHOD': handle_shipping_method,
+    }
+
+    state_handler = states_functions[user_state]
+    context = AsyncContext(bot, bot_data, chat_id, session)
+    try:
+        next_state = await asyncio.wait_for(
+            state_handler(update, context),
+            bot_data.get('update_budget', UPDATE_BUDGET)
+        )
+    except (CircuitOpenError, asyncio.TimeoutError) as error:
+        logger.warning('%s, апдейт чата %s не обработан', error, chat_id)
+        await bot.call(
+            'sendMessage',
+            chat_id=chat_id,
+            text=get_unavailable_text()
+        )
+        return
+    await session_store.save(chat_id, next_state, session)
+
+
+class AsyncDispatcher:
+    """
+    Запускает обработку каждого апдейта отдельной задачей. Апдейты
+    одного чата ждут друг друга на замке чата, число одновременно
+    обрабатываемых апдейтов ограничено max_concurrency.
+    """
+
+    def __init__(self, bot, bot_data, max_concurrency=1000):
+        self.bot = bot
+        self.bot_data = bot_data
+        self._chat_locks = weakref.WeakValueDictionary()
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def dispatch(self, update):
+        await self._semaphore.acquire()
+        chat_lock = self._chat_locks.setdefault(
+            get_chat_id(update), asyncio.Lock()
+        )
+        run_in_background(self._process(update, chat_lock))
+
+    async def _process(self, update, chat_lock):
+        try:
+            async with chat_lock:
+                await handle_users_reply(update, self.bot, self.bot_data)
+        except Exception:
+            logger.exception('Ошибка при обработке апдейта %s', update)
+        finally:
+            self._semaphore.release()
+
+
+async def load_catalog(moltin):
+    products = await moltin.get_all_products()
+    return render_catalog(products['data'])
+
+
+async def load_pizzerias(moltin, pizzeria_registry):
+    pizzerias = await moltin.get_all_pizzerias()
+    await asyncio.to_thread(pizzeria_registry.update, pizzerias)
+    return pizzeria_registry
+
+
+async def poll_updates(bot, dispatcher):
+    offset = None
+    while True:
+        try:
+            updates = await bot.get_updates(offset)
+        except (aiohttp.ClientError, asyncio.TimeoutError, TelegramError):
+            logger.exception('Не удалось получить апдейты')
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            offset = update['update_id'] + 1
+            await dispatcher.dispatch(update)
+
+
+async def run_bot():
+    load_dotenv()
+    client_id = os.getenv('CLIENT_ID')
+    client_secret = os.getenv('CLIENT_SECRET')
+    pool_size = int(os.getenv('ASYNC_POOL_SIZE', 100))
+    max_concurrency = int(os.getenv('ASYNC_MAX_CONCURRENCY', 1000))
+    redis_connection = redis.asyncio.Redis(
+        host=os.getenv('REDIS_HOST'),
+        port=os.getenv('REDIS_PORT'),
+        db=0,
+        password=os.getenv('REDIS_PASSWORD'),
+        decode_responses=True,
+        max_connections=pool_size
+    )
+    connector = aiohttp.TCPConnector(limit=pool_size)
+    async with aiohttp.ClientSession(connector=connector) as http_session:
+        bot = AsyncTelegramBot(http_session, os.getenv('TG_TOKEN'))
+        moltin = AsyncMoltinClient(http_session, client_id, client_secret)
+        bot_data = {
+            'moltin': moltin,
+            'payment_token': os.getenv('PAYMENT_TOKEN'),
+            'update_budget': float(os.getenv('UPDATE_BUDGET', UPDATE_BUDGET)),
+            'sessions': AsyncSessionStore(redis_connection),
+            'geocoder': AsyncGeocodingCache(
+                redis_connection,
+                os.getenv('YANDEX_GEOCODER_API_KEY'),
+                http_session
+            ),
+            'catalog': AsyncStaleWhileRevalidate(
+                partial(load_catalog, moltin),
+                int(os.getenv('CATALOG_TTL', CATALOG_TTL))
+            ),
+            'product_cards': LRUCache(PRODUCT_CARDS_MAXSIZE),
+            'pizzerias': AsyncStaleWhileRevalidate(
+                partial(
+                    load_pizzerias,
+                    moltin,
+                    PizzeriaRegistry(
+                        DeliveryZones(os.getenv('DELIVERY_ZONES_PATH'))
+                    )
+                ),
+                int(os.getenv('PIZZERIAS_TTL', PIZZERIAS_TTL))
+            ),
+        }
+        bot_data['jobs'] = JobScheduler(connect_redis(), {
+            'write_to_customer': run_on_loop(
+                asyncio.get_running_loop(),
+                partial(write_to_customer, bot),
+                FOLLOW_UP_SEND_TIMEOUT
+            ),
+            'create_customer_entry': run_on_loop(
+                asyncio.get_running_loop(),
+                partial(write_customer_entry, moltin),
+                FOLLOW_UP_SEND_TIMEOUT
+            ),
+        }, workers=int(os.getenv('JOBS_WORKERS', 4)))
+        bot_data['invalidation'] = asyncio.create_task(
+            listen_invalidations(redis_connection, bot_data)
+        )
+        dispatcher = AsyncDispatcher(bot, bot_data, max_concurrency)
+        try:
+            await poll_updates(bot, dispatcher)
+        finally:
+            await asyncio.to_thread(bot_data['jobs'].close)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(run_bot())
+
+
+if __name__ == '__main__':
+    main()
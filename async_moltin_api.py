@@ -0,0 +1,169 @@
+import asyncio
+import time
+from urllib.parse import parse_qsl, urlparse
+
+import aiohttp
+
+from breakers import get_breaker
+from moltin_api import MOLTIN_API_URL, PAGE_LIMIT, RETRY_STATUSES
+
+IDEMPOTENT_METHODS = ('GET', 'DELETE', 'PUT')
+
+
+class AsyncMoltinClient:
+    """
+    Асинхронный клиент Moltin API поверх общей aiohttp-сессии.
+    Токен обновляется одним запросом за раз, остальные корутины ждут его.
+    """
+
+    def __init__(self, http_session, client_id, client_secret, timeout=10,
+                 retries=3, backoff_factor=0.3, base_url=MOLTIN_API_URL):
+        self.http_session = http_session
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.base_url = base_url
+        self.breaker = get_breaker('moltin')
+        self.token = None
+        self.expires = 0
+        self._token_lock = asyncio.Lock()
+
+    async def get_access_token(self):
+        if time.time() < self.expires:
+            return self.token
+        async with self._token_lock:
+            if time.time() < self.expires:
+                return self.token
+            data = {
+                'grant_type': 'client_credentials',
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+            }
+            with self.breaker.guard():
+                async with self.http_session.post(
+                    f'{self.base_url}/oauth/access_token',
+                    data=data,
+                    timeout=self.timeout
+                ) as response:
+                    response.raise_for_status()
+                    decoded_response = await response.json()
+            self.token = decoded_response.get('access_token')
+            self.expires = decoded_response.get('expires')
+        return self.token
+
+    async def request(self, method, path, **kwargs):
+        headers = {
+            'Authorization': f'Bearer {await self.get_access_token()}',
+        }
+        retries = self.retries if method in IDEMPOTENT_METHODS else 0
+        with self.breaker.guard():
+            for attempt in range(retries + 1):
+                async with self.http_session.request(
+                    method,
+                    f'{self.base_url}{path}',
+                    headers=headers,
+                    timeout=self.timeout,
+                    **kwargs
+                ) as response:
+                    if response.status in RETRY_STATUSES \
+                            and attempt < retries:
+                        delay = response.headers.get('Retry-After')
+                        delay = float(delay) if delay and delay.isdigit() \
+                            else self.backoff_factor * 2 ** attempt
+                    else:
+                        response.raise_for_status()
+                        return await response.json()
+                await asyncio.sleep(delay)
+
+    async def create_customer_entry(self, chat_id, lat, lon):
+        data = {
+            'data': {
+                'type': 'entry',
+                'chat_id': chat_id,
+                'lat': lat,
+                'lon': lon
+            }
+        }
+        await self.request(
+            'POST', '/v2/flows/customer_address/entries', json=data
+        )
+
+    async def add_product_to_cart(self, cart_id, product_id, quantity):
+        data = {
+            'data': {
+                'id': product_id,
+                'type': 'cart_item',
+                'quantity': quantity
+            }
+        }
+        await self.request('POST', f'/v2/carts/{cart_id}/items', json=data)
+
+    async def remove_product_from_cart(self, cart_id, product_id):
+        return await self.request(
+            'DELETE', f'/v2/carts/{cart_id}/items/{product_id}'
+        )
+
+    async def get_cart_products(self, cart_id):
+        return await self.request('GET', f'/v2/carts/{cart_id}/items')
+
+    async def get_page(self, path, limit=PAGE_LIMIT, offset=0):
+        params = {'page[limit]': limit, 'page[offset]': offset}
+        return await self.request('GET', path, params=params)
+
+    async def iter_pages(self, path, limit=PAGE_LIMIT, prefetch=4):
+        """
+        Страницы коллекции по одной, как MoltinClient.iter_pages:
+        после первой страницы остальные запрашиваются пачками
+        по prefetch штук, без общего числа записей — по links.next.
+        """
+        page = await self.get_page(path, limit)
+        yield page
+        meta = page.get('meta') or {}
+        total = (meta.get('results') or {}).get('total')
+        if total is None:
+            next_url = (page.get('links') or {}).get('next')
+            while page['data'] and next_url:
+                next_url = urlparse(next_url)
+                page = await self.request(
+                    'GET',
+                    next_url.path,
+                    params=dict(parse_qsl(next_url.query))
+                )
+                yield page
+                next_url = (page.get('links') or {}).get('next')
+            return
+
+        limit = (meta.get('page') or {}).get('limit') or limit
+        offsets = range(limit, total, limit)
+        for start in range(0, len(offsets), prefetch):
+            pages = await asyncio.gather(*(
+                self.get_page(path, limit, offset)
+                for offset in offsets[start:start + prefetch]
+            ))
+            for page in pages:
+                yield page
+
+    async def iter_items(self, path, **kwargs):
+        async for page in self.iter_pages(path, **kwargs):
+            for item in page['data']:
+                yield item
+
+    async def get_all_products(self):
+        return {
+            'data': [item async for item in self.iter_items('/pcm/products')]
+        }
+
+    async def get_product_by_id(self, product_id):
+        return await self.request('GET', f'/catalog/products/{product_id}')
+
+    async def get_img_url(self, img_id):
+        response = await self.request('GET', f'/v2/files/{img_id}')
+        return response['data']['link']['href']
+
+    async def get_all_pizzerias(self, flow_slug='pizzeria'):
+        return [
+            item
+            async for item in self.iter_items(f'/v2/flows/{flow_slug}/entries')
+        ]
@@ -0,0 +1,433 @@
+"""
+Нагрузочный прогон бота без внешних сервисов.
+
+Поднимает локальные заглушки Moltin, геокодера Яндекса и Bot API с
+настраиваемыми задержкой и долей ошибок, прогоняет через
+handle_users_reply полный сценарий заказа и печатает задержки по
+состояниям, число запросов к внешним сервисам на заказ и пропускную
+способность при разной конкурентности. Нужен только Redis из .env.
+
+    python benchmark.py --orders 200 --concurrency 1,4,16
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import statistics
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from dotenv import load_dotenv
+from telegram import Bot, Update
+from telegram.ext import CallbackContext, Dispatcher
+
+import moltin_api
+import yandex_api
+from instrumented_clients import InstrumentedRequest
+from outbox import Outbox
+from tg_bot import handle_users_reply, prepare, setup_dispatcher
+
+PRODUCTS_COUNT = 8
+PIZZERIAS_COUNT = 200
+ADDRESSES_COUNT = 20
+
+
+class FakeUpstreams:
+    """Состояние заглушек: каталог, пиццерии, корзины и счётчики запросов."""
+
+    def __init__(self, latencies, error_rate):
+        self.latencies = latencies
+        self.error_rate = error_rate
+        self.calls = Counter()
+        self.carts = defaultdict(dict)
+        self._lock = threading.Lock()
+        self._message_ids = itertools.count(1)
+        self.products = [
+            {
+                'id': f'product-{number}',
+                'attributes': {
+                    'name': f'Пицца {number}',
+                    'description': 'Тесто, соус, сыр',
+                },
+                'relationships': {
+                    'main_image': {'data': {'id': f'file-{number}'}},
+                },
+                'meta': {
+                    'display_price': {
+                        'without_tax': {'formatted': '₽500.00'},
+                    },
+                },
+            }
+            for number in range(PRODUCTS_COUNT)
+        ]
+        randomizer = random.Random(0)
+        self.pizzerias = [
+            {
+                'id': f'pizzeria-{number}',
+                'address': f'Пиццерия {number}',
+                'lat': 55.55 + randomizer.random() * 0.4,
+                'lon': 37.35 + randomizer.random() * 0.5,
+                'chat_id': 1000 + number,
+            }
+            for number in range(PIZZERIAS_COUNT)
+        ]
+
+    def get_upstream(self, path):
+        if path.startswith('/bot'):
+            return 'telegram'
+        if path.startswith('/1.x'):
+            return 'yandex'
+        return 'moltin'
+
+    def handle(self, method, path, body):
+        upstream = self.get_upstream(path)
+        with self._lock:
+            self.calls[upstream] += 1
+        time.sleep(self.latencies[upstream])
+        if random.random() < self.error_rate and '/oauth/' not in path:
+            return 503, {'errors': [{'detail': 'injected error'}]}
+        if upstream == 'telegram':
+            return 200, self.handle_telegram(path, body)
+        if upstream == 'yandex':
+            return 200, self.handle_yandex()
+        path, _, query = path.partition('?')
+        return self.handle_moltin(method, path, body, parse_qs(query))
+
+    def handle_telegram(self, path, body):
+        bot_method = path.rsplit('/', 1)[-1]
+        if bot_method in ('deleteMessage', 'answerCallbackQuery'):
+            return {'ok': True, 'result': True}
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': body.get('chat_id'), 'type': 'private'},
+        }
+        photo = body.get('photo') or body.get('media', {}).get('media')
+        if bot_method in ('sendPhoto', 'editMessageMedia'):
+            message['photo'] = [{
+                'file_id': f'photo-{photo}',
+                'file_unique_id': 'photo',
+                'width': 800,
+                'height': 600,
+            }]
+        return {'ok': True, 'result': message}
+
+    def handle_yandex(self):
+        lat = 55.6 + random.random() * 0.3
+        lon = 37.4 + random.random() * 0.4
+        return {
+            'response': {
+                'GeoObjectCollection': {
+                    'featureMember': [
+                        {'GeoObject': {'Point': {'pos': f'{lon} {lat}'}}},
+                    ],
+                },
+            },
+        }
+
+    def render_cart(self, cart_id):
+        items = []
+        total = 0
+        for product_id, quantity in self.carts[cart_id].items():
+            total += 500 * quantity
+            items.append({
+                'id': f'item-{product_id}',
+                'product_id': product_id,
+                'name': f'Пицца {product_id}',
+                'description': 'Тесто, соус, сыр',
+                'quantity': quantity,
+                'meta': {
+                    'display_price': {
+                        'with_tax': {
+                            'value': {
+                                'amount': 50000 * quantity,
+                                'formatted': f'₽{500 * quantity}.00',
+                            },
+                        },
+                    },
+                },
+            })
+        display_price = {
+            'with_tax': {
+                'amount': total * 100,
+                'currency': 'RUB',
+                'formatted': f'₽{total}.00',
+            },
+        }
+        return {'data': items, 'meta': {'display_price': display_price}}
+
+    def paginate(self, items, query):
+        limit = min(int(query.get('page[limit]', [25])[0]), 100)
+        offset = int(query.get('page[offset]', [0])[0])
+        return {
+            'data': items[offset:offset + limit],
+            'meta': {
+                'page': {'limit': limit, 'offset': offset},
+                'results': {'total': len(items)},
+            },
+        }
+
+    def handle_moltin(self, method, path, body, query):
+        parts = path.strip('/').split('/')
+        if path == '/oauth/access_token':
+            expires = time.time() + 3600
+            return 200, {'access_token': 'bench', 'expires': expires}
+        if path == '/pcm/products':
+            return 200, self.paginate(self.products, query)
+        if parts[:2] == ['catalog', 'products']:
+            product = next(
+                product for product in self.products
+                if product['id'] == parts[2]
+            )
+            return 200, {'data': product}
+        if parts[:2] == ['v2', 'files']:
+            link = {'href': f'https://cdn/{parts[2]}'}
+            return 200, {'data': {'link': link}}
+        if parts[:3] == ['v2', 'flows', 'pizzeria']:
+            return 200, self.paginate(self.pizzerias, query)
+        if parts[:3] == ['v2', 'flows', 'customer_address']:
+            return 201, {'data': body.get('data')}
+        if parts[:2] == ['v2', 'carts']:
+            cart_id = parts[2]
+            with self._lock:
+                if method == 'POST':
+                    product_id = body['data']['id']
+                    cart = self.carts[cart_id]
+                    cart[product_id] = cart.get(product_id, 0) + 1
+                elif method == 'DELETE':
+                    product_id = parts[4].removeprefix('item-')
+                    self.carts[cart_id].pop(product_id, None)
+                cart = self.render_cart(cart_id)
+            if len(parts) == 3:
+                return 200, {'data': {'meta': cart['meta']}}
+            return 200, cart
+        return 404, {'errors': [{'detail': f'unknown path {path}'}]}
+
+
+def make_request_handler(upstreams):
+    class FakeUpstreamHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def handle_request(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            raw_body = self.rfile.read(length) if length else b''
+            content_type = self.headers.get('Content-Type', '')
+            if raw_body and 'json' in content_type:
+                body = json.loads(raw_body)
+            else:
+                body = {}
+            status, payload = upstreams.handle(self.command, self.path, body)
+            encoded_payload = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(encoded_payload)))
+            self.end_headers()
+            self.wfile.write(encoded_payload)
+
+        do_GET = do_POST = do_DELETE = handle_request
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeUpstreamHandler
+
+
+def start_fake_upstreams(upstreams):
+    server = ThreadingHTTPServer(
+        ('127.0.0.1', 0), make_request_handler(upstreams)
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def build_dispatcher(base_url, workers):
+    for name in ('CLIENT_ID', 'CLIENT_SECRET', 'PAYMENT_TOKEN'):
+        os.environ.setdefault(name, 'bench')
+    os.environ.setdefault('YANDEX_GEOCODER_API_KEY', 'bench')
+    bot = Bot(
+        '123:bench',
+        base_url=f'{base_url}/bot',
+        request=InstrumentedRequest(con_pool_size=2 * workers + 4)
+    )
+    dispatcher = Dispatcher(bot, None, workers=1)
+    setup_dispatcher(dispatcher, workers)
+    # Заглушке Bot API лимиты Telegram не нужны: очередь отправки
+    # должна мерить задержки, а не ждать токенов.
+    dispatcher.bot_data['outbox'].close()
+    dispatcher.bot_data['outbox'] = Outbox(
+        bot,
+        workers=workers,
+        global_rate=10 ** 6,
+        chat_rate=10 ** 6,
+        chat_burst=10 ** 6
+    )
+
+    moltin_api.configure_client(
+        os.environ['CLIENT_ID'],
+        os.environ['CLIENT_SECRET'],
+        pool_size=workers + int(os.getenv('JOBS_WORKERS', 4))
+        + moltin_api.PAGE_PREFETCH,
+        base_url=base_url,
+        db_connection=dispatcher.bot_data['db_connection']
+    )
+    yandex_api.YANDEX_GEOCODER_URL = f'{base_url}/1.x'
+    prepare(dispatcher.bot_data, workers)
+    return dispatcher
+
+
+def make_conversation(chat_id, product_id):
+    user = {'id': chat_id, 'is_bot': False, 'first_name': 'Bench'}
+    chat = {'id': chat_id, 'type': 'private'}
+    update_ids = itertools.count(1)
+
+    def message(text):
+        return {
+            'update_id': next(update_ids),
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': chat,
+                'from': user,
+                'text': text,
+            },
+        }
+
+    def callback(data):
+        return {
+            'update_id': next(update_ids),
+            'callback_query': {
+                'id': str(next(update_ids)),
+                'from': user,
+                'chat_instance': str(chat_id),
+                'data': data,
+                'message': {
+                    'message_id': 1,
+                    'date': int(time.time()),
+                    'chat': chat,
+                },
+            },
+        }
+
+    address = f'Москва, ул. Тверская, д. {chat_id % ADDRESSES_COUNT}'
+    return [
+        ('START', message('/start')),
+        ('HANDLE_MENU', callback(product_id)),
+        ('HANDLE_DESCRIPTION', callback('add_to_cart')),
+        ('HANDLE_CART', callback('cart')),
+        ('HANDLE_CART:payment', callback('payment')),
+        ('LOCATION_WAITING', message(address)),
+        ('HANDLE_SHIPPING_METHOD', callback('shipping')),
+    ]
+
+
+def run_order(dispatcher, chat_id, product_id, timings, timings_lock):
+    for label, raw_update in make_conversation(chat_id, product_id):
+        update = Update.de_json(raw_update, dispatcher.bot)
+        context = CallbackContext.from_update(update, dispatcher)
+        started_at = time.perf_counter()
+        handle_users_reply(update, context)
+        elapsed = time.perf_counter() - started_at
+        with timings_lock:
+            timings[label].append(elapsed)
+
+
+def get_percentiles(values):
+    if len(values) < 2:
+        return values * 3
+    quantiles = statistics.quantiles(values, n=100, method='inclusive')
+    return quantiles[49], quantiles[94], quantiles[98]
+
+
+def run_level(dispatcher, upstreams, concurrency, orders, first_chat_id):
+    timings = defaultdict(list)
+    timings_lock = threading.Lock()
+    calls_before = upstreams.calls.copy()
+    failed_orders = 0
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [
+            executor.submit(
+                run_order,
+                dispatcher,
+                first_chat_id + number,
+                upstreams.products[number % PRODUCTS_COUNT]['id'],
+                timings,
+                timings_lock
+            )
+            for number in range(orders)
+        ]
+        for future in futures:
+            if future.exception():
+                failed_orders += 1
+    dispatcher.bot_data['outbox'].wait_idle()
+    elapsed = time.perf_counter() - started_at
+
+    calls = upstreams.calls - calls_before
+    completed_orders = orders - failed_orders
+    print(
+        f'\nКонкурентность {concurrency}: {completed_orders} заказов '
+        f'за {elapsed:.2f} с, {completed_orders / elapsed:.1f} заказов/с, '
+        f'ошибок {failed_orders}'
+    )
+    calls_per_order = ', '.join(
+        f'{upstream} {calls[upstream] / orders:.1f}'
+        for upstream in ('moltin', 'yandex', 'telegram')
+    )
+    print(
+        f'Запросов на заказ: {sum(calls.values()) / orders:.1f} '
+        f'({calls_per_order})'
+    )
+    print(f'{"Состояние":<26}{"p50, мс":>10}{"p95, мс":>10}{"p99, мс":>10}')
+    for label, values in timings.items():
+        p50, p95, p99 = (value * 1000 for value in get_percentiles(values))
+        print(f'{label:<26}{p50:>10.1f}{p95:>10.1f}{p99:>10.1f}')
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--orders', type=int, default=100)
+    parser.add_argument('--concurrency', default='1,4,16',
+                        help='Уровни конкурентности через запятую')
+    parser.add_argument('--moltin-latency', type=float, default=80,
+                        help='Задержка Moltin, мс')
+    parser.add_argument('--yandex-latency', type=float, default=300,
+                        help='Задержка геокодера, мс')
+    parser.add_argument('--telegram-latency', type=float, default=50,
+                        help='Задержка Bot API, мс')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Доля ответов 503 от заглушек')
+    args = parser.parse_args()
+
+    upstreams = FakeUpstreams(
+        {
+            'moltin': args.moltin_latency / 1000,
+            'yandex': args.yandex_latency / 1000,
+            'telegram': args.telegram_latency / 1000,
+        },
+        args.error_rate
+    )
+    base_url = start_fake_upstreams(upstreams)
+    levels = [int(level) for level in args.concurrency.split(',')]
+    dispatcher = build_dispatcher(base_url, max(levels))
+
+    first_chat_id = random.randint(10 ** 9, 2 * 10 ** 9)
+    for concurrency in levels:
+        run_level(
+            dispatcher, upstreams, concurrency, args.orders, first_chat_id
+        )
+        first_chat_id += args.orders
+    dispatcher.bot_data['jobs'].close()
+    dispatcher.bot_data['outbox'].close()
+    dispatcher.bot_data['sessions'].close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from metrics import Gauge, register
+
+CLOSED = 'closed'
+HALF_OPEN = 'half_open'
+OPEN = 'open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, upstream):
+        super().__init__(f'{upstream} временно недоступен')
+        self.upstream = upstream
+
+
+def is_upstream_error(error):
+    """Ответы 4xx, кроме 429, — ошибки запроса, а не отказ сервиса."""
+    response = getattr(error, 'response', None)
+    status = getattr(response, 'status_code', None) \
+        or getattr(error, 'status', None)
+    return status is None or status >= 500 or status == 429
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для внешнего сервиса. Помнит исходы последних window
+    вызовов; вызов считается плохим, если упал или шёл дольше
+    slow_call_seconds. Когда плохих набирается failure_ratio (и вызовов
+    не меньше min_calls), предохранитель размыкается и сразу отвечает
+    CircuitOpenError. Через reset_timeout пропускает один пробный
+    вызов: удачный замыкает цепь, неудачный снова размыкает.
+    """
+
+    def __init__(self, name, window=20, min_calls=5, failure_ratio=.5,
+                 slow_call_seconds=3, reset_timeout=15):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.slow_call_seconds = slow_call_seconds
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.rejected_count = 0
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN \
+                    and time.monotonic() - self._opened_at >= self.reset_timeout:
+                self.state = HALF_OPEN
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return
+            self.rejected_count += 1
+        raise CircuitOpenError(self.name)
+
+    def record(self, elapsed, success):
+        bad = not success or elapsed > self.slow_call_seconds
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if bad:
+                    self._open()
+                else:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                return
+            self._outcomes.append(bad)
+            if self.state == CLOSED \
+                    and len(self._outcomes) >= self.min_calls \
+                    and sum(self._outcomes) >= \
+                    self.failure_ratio * len(self._outcomes):
+                self._open()
+
+    @contextmanager
+    def guard(self):
+        """
+        Отмена вызова (CancelledError, KeyboardInterrupt) тоже считается
+        неудачей, иначе брошенный пробный вызов навсегда занял бы место.
+        """
+        self.before_call()
+        started_at = time.monotonic()
+        success = False
+        try:
+            yield
+            success = True
+        except Exception as error:
+            success = not is_upstream_error(error)
+            raise
+        finally:
+            self.record(time.monotonic() - started_at, success)
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+
+
+BREAKERS = {}
+BREAKERS_LOCK = threading.Lock()
+
+
+def get_breaker(upstream):
+    with BREAKERS_LOCK:
+        if upstream not in BREAKERS:
+            BREAKERS[upstream] = CircuitBreaker(upstream)
+        return BREAKERS[upstream]
+
+
+def collect_states():
+    return [
+        ((('upstream', name),), STATE_VALUES[breaker.state])
+        for name, breaker in sorted(BREAKERS.items())
+    ]
+
+
+def collect_rejected():
+    return [
+        ((('upstream', name),), breaker.rejected_count)
+        for name, breaker in sorted(BREAKERS.items())
+    ]
+
+
+register(Gauge(
+    'tg_pizza_circuit_breaker_state',
+    'Состояние предохранителя: 0 — замкнут, 1 — пробный вызов, 2 — разомкнут',
+    collect_states
+))
+register(Gauge(
+    'tg_pizza_circuit_breaker_rejected_total',
+    'Вызовы, отклонённые разомкнутым предохранителем',
+    collect_rejected
+))
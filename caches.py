@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class StaleWhileRevalidate:
+    """
+    Значение с TTL: после истечения срока отдаётся старое значение,
+    а новое загружается в фоновом потоке. Синхронная загрузка
+    выполняется только если значения ещё нет. Если обновить не
+    удалось, старое значение отдаётся дальше, а следующая попытка
+    будет через retry_delay секунд. Значение, загрузка которого
+    началась до invalidate(), сохраняется сразу устаревшим.
+    """
+
+    def __init__(self, loader, ttl, retry_delay=5):
+        self.loader = loader
+        self.ttl = ttl
+        self.retry_delay = retry_delay
+        self._value = None
+        self._loaded_at = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def get(self):
+        if self._loaded_at is None:
+            with self._lock:
+                if self._loaded_at is None:
+                    generation = self._generation
+                    self._store(self.loader(), generation)
+            return self._value
+        if time.monotonic() - self._loaded_at > self.ttl:
+            self.refresh_in_background()
+        return self._value
+
+    def refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._refresh, daemon=True).start()
+
+    def invalidate(self):
+        self._generation += 1
+        if self._loaded_at is not None:
+            self._loaded_at = float('-inf')
+
+    def _refresh(self):
+        generation = self._generation
+        try:
+            self._store(self.loader(), generation)
+        except Exception:
+            logger.exception('Не удалось обновить %r', self.loader)
+            self._postpone()
+        finally:
+            self._refreshing = False
+
+    def _postpone(self):
+        self._loaded_at = time.monotonic() - self.ttl + self.retry_delay
+
+    def _store(self, value, generation):
+        self._value = value
+        if generation == self._generation:
+            self._loaded_at = time.monotonic()
+        else:
+            self._loaded_at = float('-inf')
+
+
+class AsyncStaleWhileRevalidate(StaleWhileRevalidate):
+    """То же для асинхронного загрузчика: обновление идёт фоновой задачей."""
+
+    def __init__(self, loader, ttl, retry_delay=5):
+        super().__init__(loader, ttl, retry_delay)
+        self._async_lock = asyncio.Lock()
+        self._tasks = set()
+
+    async def get(self):
+        if self._loaded_at is None:
+            async with self._async_lock:
+                if self._loaded_at is None:
+                    generation = self._generation
+                    self._store(await self.loader(), generation)
+            return self._value
+        if time.monotonic() - self._loaded_at > self.ttl:
+            self.refresh_in_background()
+        return self._value
+
+    def refresh_in_background(self):
+        if self._refreshing:
+            return
+        self._refreshing = True
+        task = asyncio.create_task(self._refresh())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self):
+        generation = self._generation
+        try:
+            self._store(await self.loader(), generation)
+        except Exception:
+            logger.exception('Не удалось обновить %r', self.loader)
+            self._postpone()
+        finally:
+            self._refreshing = False
+
+
+class LRUCache:
+    """Словарь ограниченного размера, вытесняющий давно не читанные ключи."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def items(self):
+        with self._lock:
+            return list(self._data.items())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
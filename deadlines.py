@@ -0,0 +1,74 @@
+import threading
+import time
+from contextlib import contextmanager
+
+UPDATE_BUDGET = 10
+
+current = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self):
+        super().__init__('Бюджет времени на апдейт исчерпан')
+
+
+class Deadline:
+    """
+    Срок, к которому апдейт должен быть обработан. Пока срок активен
+    в потоке, запросы к Moltin, геокодеру и Redis берут таймаут из
+    оставшегося времени, а после срока не отправляются вовсе.
+    """
+
+    def __init__(self, budget):
+        self.expires_at = time.monotonic() + budget
+
+    @property
+    def remaining(self):
+        return self.expires_at - time.monotonic()
+
+    def is_expired(self):
+        return self.remaining <= 0
+
+    @contextmanager
+    def active(self):
+        previous_deadline = get_deadline()
+        current.deadline = self
+        try:
+            yield self
+        finally:
+            current.deadline = previous_deadline
+
+
+def get_deadline():
+    return getattr(current, 'deadline', None)
+
+
+def get_timeout(default):
+    """
+    Таймаут для очередного запроса: default, но не больше остатка
+    бюджета. default может быть парой (connect, read), как в requests.
+    """
+    deadline = get_deadline()
+    if deadline is None:
+        return default
+    remaining = deadline.remaining
+    if remaining <= 0:
+        raise DeadlineExceeded()
+    if default is None:
+        return remaining
+    if isinstance(default, tuple):
+        return tuple(min(part, remaining) for part in default)
+    return min(default, remaining)
+
+
+def bind_deadline(func):
+    """Переносит срок текущего потока в функцию, запускаемую в другом."""
+    deadline = get_deadline()
+    if deadline is None:
+        return func
+
+    def run_with_deadline(*args, **kwargs):
+        with deadline.active():
+            return func(*args, **kwargs)
+
+    return run_with_deadline
@@ -0,0 +1,406 @@
+"""
+Сетка зон доставки по пиццериям из flow.
+
+Собирается заранее и сохраняется в файл, который бот читает при старте:
+
+    python delivery_zones.py delivery_zones.bin
+"""
+import hashlib
+import json
+import logging
+import math
+import os
+import sys
+import threading
+from collections import namedtuple
+
+from pizzerias import (
+    EARTH_RADIUS_KM, build_tree, chord_to_km, search_tree, to_unit_vector
+)
+
+DELIVERY_TIERS = (
+    (.5, 0),
+    (5, 100),
+    (20, 300),
+)
+NO_DELIVERY = len(DELIVERY_TIERS)
+BOUNDARY = -1
+MAX_CANDIDATES = 4
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+logger = logging.getLogger(__name__)
+
+
+def get_tier(distance_km):
+    for tier, (max_distance_km, _) in enumerate(DELIVERY_TIERS):
+        if distance_km <= max_distance_km:
+            return tier
+    return NO_DELIVERY
+
+
+def get_distance_km(first_coords, second_coords):
+    squared_chord = sum(
+        (a - b) ** 2
+        for a, b in zip(
+            to_unit_vector(*first_coords),
+            to_unit_vector(*second_coords)
+        )
+    )
+    return chord_to_km(squared_chord)
+
+
+def get_points(pizzerias):
+    return {
+        pizzeria['id']: (float(pizzeria['lat']), float(pizzeria['lon']))
+        for pizzeria in pizzerias
+    }
+
+
+def get_points_fingerprint(points):
+    encoded_points = json.dumps(sorted(points.items())).encode()
+    return hashlib.sha1(encoded_points).hexdigest()
+
+
+Grid = namedtuple('Grid', 'points pizzeria_ids cells origin steps')
+EMPTY_GRID = Grid({}, [], {}, None, None)
+
+
+class DeliveryZones:
+    """
+    Сетка над зоной доставки: для каждой ячейки заранее посчитаны
+    ближайшая пиццерия и тариф из DELIVERY_TIERS. Ячейка считается
+    определённой, только если пиццерия и тариф одинаковы во всех её
+    точках с запасом tolerance на разницу сферы и эллипсоида. Остальные
+    ячейки помечены BOUNDARY и хранят несколько пиццерий-кандидатов:
+    точное расстояние считается только до них.
+
+    Хранятся только ячейки в радиусе доставки какой-нибудь пиццерии —
+    в словаре по (строка, столбец); для остальных точек lookup
+    возвращает None. Сетка сохраняется в path и читается оттуда, если
+    собрана для тех же пиццерий. Иначе она собирается в фоновом потоке,
+    а пока сборка идёт, lookup возвращает None и пиццерия ищется по
+    KD-дереву. Когда пиццерии только добавляются, пересчитываются лишь
+    ячейки рядом с новыми пиццериями.
+    """
+
+    def __init__(self, path=None, cell_km=.5, tolerance=.006):
+        self.path = path
+        self.cell_km = cell_km
+        self.tolerance = tolerance
+        self.fingerprint = None
+        self.grid = EMPTY_GRID
+        self._building_fingerprint = None
+        self._lock = threading.Lock()
+
+    @property
+    def cell_radius_km(self):
+        return self.cell_km * math.sqrt(2) / 2
+
+    def lookup(self, coords):
+        """
+        Возвращает (расстояние в км, id пиццерии) или None, если точка
+        вне сетки или у ячейки слишком много кандидатов.
+        """
+        grid = self.grid
+        if grid.origin is None:
+            return None
+        lat, lon = (float(coordinate) for coordinate in coords)
+        cell = grid.cells.get(self._get_cell((lat, lon), grid.origin,
+                                             grid.steps))
+        if cell is None:
+            return None
+        tier, positions = cell
+        if tier != BOUNDARY:
+            pizzeria_id = grid.pizzeria_ids[positions[0]]
+            distance_km = get_distance_km(
+                (lat, lon),
+                grid.points[pizzeria_id]
+            )
+            return distance_km, pizzeria_id
+
+        if not positions:
+            return None
+        pizzeria_ids = [grid.pizzeria_ids[position] for position in positions]
+        nearest = sorted(
+            (get_distance_km((lat, lon), grid.points[pizzeria_id]),
+             pizzeria_id)
+            for pizzeria_id in pizzeria_ids
+        )
+        farthest_km = nearest[0][0] * (1 + self.tolerance)
+        contenders = [
+            (distance_km, pizzeria_id) for distance_km, pizzeria_id in nearest
+            if distance_km * (1 - self.tolerance) <= farthest_km
+        ]
+        closest_km = nearest[0][0] * (1 - self.tolerance)
+        if len(contenders) == 1 and \
+                get_tier(closest_km) == get_tier(farthest_km):
+            return nearest[0]
+
+        from geopy import distance
+
+        return min(
+            (
+                distance.distance(grid.points[pizzeria_id], (lat, lon)).km,
+                pizzeria_id
+            )
+            for _, pizzeria_id in contenders
+        )
+
+    def update(self, pizzerias, wait=False):
+        """
+        Готовый файл читается сразу, а сборка уходит в фоновый поток,
+        чтобы не задерживать обновление списка пиццерий. wait=True
+        дожидается сборки — так сетку собирают заранее из консоли.
+        """
+        points = get_points(pizzerias)
+        fingerprint = get_points_fingerprint(points)
+        with self._lock:
+            if fingerprint in (self.fingerprint, self._building_fingerprint):
+                return False
+            if self.fingerprint is None and self.load(fingerprint):
+                self._building_fingerprint = None
+                return True
+            previous_grid = self.grid
+            self.grid = EMPTY_GRID
+            self._building_fingerprint = fingerprint
+        builder = threading.Thread(
+            target=self._rebuild,
+            args=(points, fingerprint, previous_grid),
+            daemon=True
+        )
+        builder.start()
+        if wait:
+            builder.join()
+        return True
+
+    def save(self):
+        grid = self.grid
+        header = {
+            'fingerprint': self.fingerprint,
+            'cell_km': self.cell_km,
+            'tolerance': self.tolerance,
+            'points': grid.points,
+            'pizzeria_ids': grid.pizzeria_ids,
+            'origin': grid.origin,
+            'steps': grid.steps,
+        }
+        cells = [
+            [row, column, tier, *positions]
+            for (row, column), (tier, positions) in grid.cells.items()
+        ]
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'wb') as zones_file:
+            zones_file.write(json.dumps(header).encode() + b'\n')
+            zones_file.write(json.dumps(cells).encode())
+        os.replace(temporary_path, self.path)
+
+    def load(self, fingerprint):
+        if not self.path or not os.path.exists(self.path):
+            return False
+        with open(self.path, 'rb') as zones_file:
+            header = json.loads(zones_file.readline())
+            settings = header.get('fingerprint'), header.get('cell_km'), \
+                header.get('tolerance')
+            if settings != (fingerprint, self.cell_km, self.tolerance) \
+                    or 'origin' not in header:
+                return False
+            cells = {
+                (row, column): (tier, tuple(positions))
+                for row, column, tier, *positions in json.load(zones_file)
+            }
+        self.grid = Grid(
+            points={
+                pizzeria_id: tuple(coords)
+                for pizzeria_id, coords in header['points'].items()
+            },
+            pizzeria_ids=header['pizzeria_ids'],
+            cells=cells,
+            origin=header['origin'] and tuple(header['origin']),
+            steps=header['steps'] and tuple(header['steps']),
+        )
+        self.fingerprint = fingerprint
+        logger.info('Зоны доставки прочитаны из %s', self.path)
+        return True
+
+    def _rebuild(self, points, fingerprint, previous_grid):
+        added_ids = points.keys() - previous_grid.points.keys()
+        unchanged = all(
+            points.get(pizzeria_id) == coords
+            for pizzeria_id, coords in previous_grid.points.items()
+        )
+        try:
+            if previous_grid.origin and unchanged and all(
+                self._fits(points[pizzeria_id], previous_grid.steps)
+                for pizzeria_id in added_ids
+            ):
+                grid = self._add(previous_grid, points, sorted(added_ids))
+                message = 'Зоны доставки дополнены: %s новых пиццерий'
+                count = len(added_ids)
+            else:
+                grid = self._build(points)
+                message = 'Зоны доставки пересобраны: %s ячеек'
+                count = len(grid.cells)
+        except Exception:
+            logger.exception('Не удалось собрать зоны доставки')
+            with self._lock:
+                if self._building_fingerprint == fingerprint:
+                    self._building_fingerprint = None
+            return
+
+        with self._lock:
+            if self._building_fingerprint != fingerprint:
+                return
+            self.grid = grid
+            self.fingerprint = fingerprint
+            self._building_fingerprint = None
+            logger.info(message, count)
+            if self.path:
+                self.save()
+
+    def _get_margin_km(self):
+        return DELIVERY_TIERS[-1][0] + self.cell_km
+
+    def _get_affected_km(self):
+        """
+        Дальше этого от центра хранимой ячейки пиццерия не может попасть
+        в её кандидаты: ближайшая к ячейке не дальше _get_margin_km.
+        """
+        radius_km = self.cell_radius_km
+        return (self._get_margin_km() * (1 + self.tolerance)
+                + 2 * radius_km) / (1 - self.tolerance)
+
+    def _fits(self, coords, steps):
+        """Ячейки сетки не шире cell_km и в окрестности coords."""
+        lat_step, lon_step = steps
+        widest_lat = math.degrees(math.acos(min(lat_step / lon_step, 1)))
+        margin = self._get_affected_km() / KM_PER_DEGREE
+        return abs(coords[0]) + margin <= widest_lat
+
+    @staticmethod
+    def _get_cell(coords, origin, steps):
+        return (
+            math.floor((coords[0] - origin[0]) / steps[0]),
+            math.floor((coords[1] - origin[1]) / steps[1]),
+        )
+
+    @staticmethod
+    def _get_center(cell, origin, steps):
+        row, column = cell
+        return (
+            origin[0] + (row + .5) * steps[0],
+            origin[1] + (column + .5) * steps[1],
+        )
+
+    def _get_reach(self, coords_list, origin, steps, reach_km):
+        """Ячейки, центры которых ближе reach_km к одной из точек."""
+        margin = reach_km / KM_PER_DEGREE
+        cells = set()
+        for lat, lon in coords_list:
+            widest_lat = min(abs(lat) + margin, 89)
+            lon_margin = margin / math.cos(math.radians(widest_lat))
+            first_row, first_column = self._get_cell(
+                (lat - margin, lon - lon_margin), origin, steps
+            )
+            last_row, last_column = self._get_cell(
+                (lat + margin, lon + lon_margin), origin, steps
+            )
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    cell = row, column
+                    if cell in cells:
+                        continue
+                    center = self._get_center(cell, origin, steps)
+                    if get_distance_km(center, (lat, lon)) <= reach_km:
+                        cells.add(cell)
+        return cells
+
+    @staticmethod
+    def _make_tree(pizzeria_ids, points):
+        return build_tree([
+            (to_unit_vector(*points[pizzeria_id]), position)
+            for position, pizzeria_id in enumerate(pizzeria_ids)
+        ])
+
+    def _classify(self, center, tree):
+        """
+        Возвращает тариф ячейки и позиции пиццерий, которые могут быть
+        ближайшими хоть в одной её точке. Если кандидатов больше
+        MAX_CANDIDATES, список пуст и ячейка ищется по всем пиццериям.
+        """
+        heap = []
+        search_tree(tree, to_unit_vector(*center), MAX_CANDIDATES + 1, heap)
+        nearest = sorted(
+            (chord_to_km(-squared_chord), position)
+            for squared_chord, position in heap
+        )
+        radius_km = self.cell_radius_km
+        farthest_km = nearest[0][0] * (1 + self.tolerance) + radius_km
+        closest_km = nearest[0][0] * (1 - self.tolerance) - radius_km
+        positions = tuple(
+            position for distance_km, position in nearest
+            if distance_km * (1 - self.tolerance) - radius_km <= farthest_km
+        )
+        if len(positions) > MAX_CANDIDATES:
+            return BOUNDARY, ()
+        tier = get_tier(max(closest_km, 0))
+        if len(positions) > 1 or tier != get_tier(farthest_km):
+            return BOUNDARY, positions
+        return tier, positions
+
+    def _build(self, points):
+        if not points:
+            return EMPTY_GRID
+        pizzeria_ids = sorted(points)
+        margin = self._get_affected_km() / KM_PER_DEGREE
+        latitudes = [lat for lat, _ in points.values()]
+        longitudes = [lon for _, lon in points.values()]
+        widest_lat = min(max(abs(lat) for lat in latitudes) + margin, 89)
+        lat_step = self.cell_km / KM_PER_DEGREE
+        lon_step = lat_step / math.cos(math.radians(widest_lat))
+        origin, steps = (min(latitudes), min(longitudes)), (lat_step, lon_step)
+
+        tree = self._make_tree(pizzeria_ids, points)
+        cells = {}
+        for cell in self._get_reach(points.values(), origin, steps,
+                                    self._get_margin_km()):
+            center = self._get_center(cell, origin, steps)
+            cells[cell] = self._classify(center, tree)
+        return Grid(points, pizzeria_ids, cells, origin, steps)
+
+    def _add(self, grid, points, added_ids):
+        pizzeria_ids = grid.pizzeria_ids + added_ids
+        tree = self._make_tree(pizzeria_ids, points)
+        cells = dict(grid.cells)
+        added_coords = [points[pizzeria_id] for pizzeria_id in added_ids]
+        new_cells = self._get_reach(added_coords, grid.origin, grid.steps,
+                                    self._get_margin_km())
+        affected_cells = self._get_reach(added_coords, grid.origin,
+                                         grid.steps, self._get_affected_km())
+        for cell in new_cells | (affected_cells & cells.keys()):
+            center = self._get_center(cell, grid.origin, grid.steps)
+            cells[cell] = self._classify(center, tree)
+        return grid._replace(
+            points=points,
+            pizzeria_ids=pizzeria_ids,
+            cells=cells,
+        )
+
+
+def main():
+    from dotenv import load_dotenv
+
+    from moltin_api import iter_pizzerias
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    path = sys.argv[1] if len(sys.argv) > 1 \
+        else os.getenv('DELIVERY_ZONES_PATH', 'delivery_zones.bin')
+    pizzerias = iter_pizzerias(
+        os.getenv('CLIENT_ID'),
+        os.getenv('CLIENT_SECRET')
+    )
+    DeliveryZones(path).update(pizzerias, wait=True)
+
+
+if __name__ == '__main__':
+    main()
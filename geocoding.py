@@ -0,0 +1,134 @@
+import json
+import re
+import threading
+import time
+from collections import Counter
+
+from caches import LRUCache
+from yandex_api import fetch_coordinates, fetch_coordinates_async
+
+ABBREVIATIONS = {
+    'ул': 'улица',
+    'пр': 'проспект',
+    'пр-т': 'проспект',
+    'просп': 'проспект',
+    'пер': 'переулок',
+    'ш': 'шоссе',
+    'наб': 'набережная',
+    'пл': 'площадь',
+    'б-р': 'бульвар',
+    'бул': 'бульвар',
+    'г': 'город',
+    'д': 'дом',
+    'корп': 'корпус',
+    'стр': 'строение',
+}
+
+
+def normalize_address(address):
+    words = re.findall(r'[\w-]+', address.lower().replace('ё', 'е'))
+    return ' '.join(ABBREVIATIONS.get(word, word) for word in words)
+
+
+class GeocodingCache:
+    """
+    Кэш геокодера в два уровня: LRU в памяти процесса и ключи
+    geocoding:<адрес> в Redis, которые Redis сам удаляет по сроку.
+    Ненайденные адреса тоже кэшируются, но на меньший срок.
+    """
+
+    def __init__(self, db_connection, apikey, maxsize=1024,
+                 ttl=30 * 24 * 60 * 60, negative_ttl=24 * 60 * 60,
+                 key_prefix='geocoding'):
+        self.db_connection = db_connection
+        self.apikey = apikey
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.key_prefix = key_prefix
+        self._local = LRUCache(maxsize)
+        self._stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    @property
+    def stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+    def fetch_coordinates(self, address):
+        key = normalize_address(address)
+        entry = self._get_local(key)
+        if entry is None:
+            raw_entry = self.db_connection.get(self.get_redis_key(key))
+            entry = self._get_shared(key, raw_entry)
+        if entry is None:
+            coords = fetch_coordinates(self.apikey, address)
+            entry = self._store(key, coords)
+            self.db_connection.set(
+                self.get_redis_key(key),
+                json.dumps(entry),
+                ex=self._get_ttl(coords)
+            )
+        return entry['coords']
+
+    def get_redis_key(self, key):
+        return f'{self.key_prefix}:{key}'
+
+    def _get_local(self, key):
+        entry = self._local.get(key)
+        if entry and entry['expires'] > time.time():
+            self._count('local_hits')
+            return entry
+        return None
+
+    def _get_shared(self, key, raw_entry):
+        if not raw_entry:
+            return None
+        entry = json.loads(raw_entry)
+        if entry['expires'] <= time.time():
+            return None
+        entry['coords'] = entry['coords'] and tuple(entry['coords'])
+        self._local.set(key, entry)
+        self._count('redis_hits')
+        return entry
+
+    def _get_ttl(self, coords):
+        return self.ttl if coords else self.negative_ttl
+
+    def _store(self, key, coords):
+        self._count('misses')
+        entry = {
+            'coords': coords,
+            'expires': time.time() + self._get_ttl(coords),
+        }
+        self._local.set(key, entry)
+        return entry
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+
+class AsyncGeocodingCache(GeocodingCache):
+    """Тот же кэш поверх redis.asyncio и асинхронного геокодера."""
+
+    def __init__(self, db_connection, apikey, http_session, **kwargs):
+        super().__init__(db_connection, apikey, **kwargs)
+        self.http_session = http_session
+
+    async def fetch_coordinates(self, address):
+        key = normalize_address(address)
+        entry = self._get_local(key)
+        if entry is None:
+            raw_entry = await self.db_connection.get(self.get_redis_key(key))
+            entry = self._get_shared(key, raw_entry)
+        if entry is None:
+            coords = await fetch_coordinates_async(
+                self.http_session, self.apikey, address
+            )
+            entry = self._store(key, coords)
+            await self.db_connection.set(
+                self.get_redis_key(key),
+                json.dumps(entry),
+                ex=self._get_ttl(coords)
+            )
+        return entry['coords']
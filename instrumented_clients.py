@@ -0,0 +1,63 @@
+import redis
+from telegram.utils.request import Request
+
+from deadlines import get_deadline, get_timeout
+from metrics import BOT_API_SECONDS, REDIS_COMMAND_SECONDS, timed
+
+
+class InstrumentedRequest(Request):
+    """Request для python-telegram-bot, замеряющий вызовы Bot API."""
+
+    def post(self, url, data, timeout=None):
+        bot_method = url.rsplit('/', 1)[-1]
+        with timed(BOT_API_SECONDS, method=bot_method, status=None) as labels:
+            result = super().post(url, data, timeout=timeout)
+            labels['status'] = 'ok'
+            return result
+
+
+class DeadlineConnection(redis.Connection):
+    """
+    Соединение с Redis, которое не отправляет команды после срока
+    апдейта и ждёт ответа не дольше оставшегося времени.
+    """
+
+    def send_packed_command(self, command, check_health=True):
+        get_timeout(None)
+        super().send_packed_command(command, check_health)
+
+    def read_response(self, *args, **kwargs):
+        deadline = get_deadline()
+        if deadline is None or self._sock is None:
+            return super().read_response(*args, **kwargs)
+        timeout = max(deadline.remaining, .001)
+        if self.socket_timeout:
+            timeout = min(timeout, self.socket_timeout)
+        self._sock.settimeout(timeout)
+        try:
+            return super().read_response(*args, **kwargs)
+        finally:
+            if self._sock is not None:
+                self._sock.settimeout(self.socket_timeout)
+
+
+class InstrumentedPipeline(redis.client.Pipeline):
+    def execute(self, raise_on_error=True):
+        with timed(REDIS_COMMAND_SECONDS, command='PIPELINE'):
+            return super().execute(raise_on_error)
+
+
+class InstrumentedRedis(redis.Redis):
+    """Клиент Redis, замеряющий каждую команду и каждый пайплайн."""
+
+    def execute_command(self, *args, **options):
+        with timed(REDIS_COMMAND_SECONDS, command=str(args[0]).upper()):
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(
+            self.connection_pool,
+            self.response_callbacks,
+            transaction,
+            shard_hint
+        )
@@ -0,0 +1,207 @@
+import asyncio
+import hmac
+import json
+import logging
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+INVALIDATION_CHANNEL = 'cache:invalidate'
+PIZZERIAS_FLOW_SLUG = 'pizzeria'
+FLOW_ENTRIES_PATTERN = re.compile(r'/flows/([^/]+)/entries')
+FULL_INVALIDATION = {
+    'catalog': True,
+    'pizzerias': True,
+    'all_products': True,
+    'product_ids': [],
+    'image_ids': [],
+}
+
+logger = logging.getLogger(__name__)
+
+
+def get_event_data(event):
+    resources = event.get('resources') or {}
+    if isinstance(resources, str):
+        resources = json.loads(resources)
+    data = resources.get('data') or {}
+    return data if isinstance(data, list) else [data]
+
+
+def get_flow_slug(entry):
+    self_link = entry.get('links', {}).get('self', '')
+    match = FLOW_ENTRIES_PATTERN.search(self_link)
+    return match and match.group(1)
+
+
+def parse_event(event):
+    """
+    Переводит событие Moltin (triggered_by вида product.updated и
+    resources с изменёнными объектами) в описание того, что сбросить.
+    Цены и каталоги задевают все карточки, товар — свою карточку и
+    меню, файл — карточки с этой картинкой, записи потока pizzeria —
+    список пиццерий. Для прочих событий возвращает None.
+    """
+    resource = event.get('triggered_by', '').rpartition('.')[0]
+    data = get_event_data(event)
+    invalidation = {
+        'catalog': False,
+        'pizzerias': False,
+        'all_products': False,
+        'product_ids': [],
+        'image_ids': [],
+    }
+    if 'price' in resource or 'catalog' in resource:
+        invalidation['catalog'] = invalidation['all_products'] = True
+    elif resource.endswith('product'):
+        invalidation['catalog'] = True
+        invalidation['product_ids'] = [item['id'] for item in data]
+    elif resource == 'file':
+        invalidation['image_ids'] = [item['id'] for item in data]
+    elif resource.endswith('entry'):
+        slugs = {get_flow_slug(entry) for entry in data} or {None}
+        invalidation['pizzerias'] = bool(
+            slugs & {PIZZERIAS_FLOW_SLUG, None}
+        )
+    if not any(invalidation.values()):
+        return None
+    return invalidation
+
+
+def mark_stale(product_cards, product_id, card):
+    product_cards.set(product_id, {**card, 'stale': True})
+
+
+def apply_invalidation(bot_data, invalidation):
+    """
+    Карточки товаров не удаляются, а помечаются устаревшими: их
+    перезагрузят при следующем показе, но если Moltin недоступен,
+    покажут старые.
+    """
+    product_cards = bot_data['product_cards']
+    if invalidation['catalog']:
+        bot_data['catalog'].invalidate()
+    if invalidation['pizzerias']:
+        bot_data['pizzerias'].invalidate()
+    product_ids = set(invalidation['product_ids'])
+    image_ids = set(invalidation['image_ids'])
+    for product_id, card in product_cards.items():
+        if invalidation['all_products'] or product_id in product_ids \
+                or card.get('image_id') in image_ids:
+            mark_stale(product_cards, product_id, card)
+
+
+def publish_invalidation(db_connection, invalidation):
+    db_connection.publish(INVALIDATION_CHANNEL, json.dumps(invalidation))
+
+
+class InvalidationSubscriber:
+    """
+    Слушает канал cache:invalidate и сбрасывает кэши процесса. После
+    обрыва подписки сбрасывает всё: сообщения, пришедшие за это
+    время, потеряны.
+    """
+
+    def __init__(self, db_connection, bot_data):
+        self.db_connection = db_connection
+        self.bot_data = bot_data
+        self._stopped = threading.Event()
+        self._listener = threading.Thread(
+            target=self._listen_forever,
+            daemon=True
+        )
+        self._listener.start()
+
+    def close(self):
+        self._stopped.set()
+        self._listener.join()
+
+    def _listen_forever(self):
+        resubscribed = False
+        while not self._stopped.is_set():
+            pubsub = self.db_connection.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                if resubscribed:
+                    apply_invalidation(self.bot_data, FULL_INVALIDATION)
+                while not self._stopped.is_set():
+                    message = pubsub.get_message(timeout=1)
+                    if message:
+                        apply_invalidation(
+                            self.bot_data,
+                            json.loads(message['data'])
+                        )
+            except Exception:
+                logger.exception('Подписка на сброс кэшей оборвалась')
+                resubscribed = True
+                self._stopped.wait(1)
+            finally:
+                pubsub.close()
+
+
+async def listen_invalidations(db_connection, bot_data):
+    """То же для асинхронного бота поверх redis.asyncio."""
+    resubscribed = False
+    while True:
+        pubsub = db_connection.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            if resubscribed:
+                apply_invalidation(bot_data, FULL_INVALIDATION)
+            async for message in pubsub.listen():
+                if message['type'] == 'message':
+                    apply_invalidation(bot_data, json.loads(message['data']))
+        except Exception:
+            logger.exception('Подписка на сброс кэшей оборвалась')
+            resubscribed = True
+            await asyncio.sleep(1)
+        finally:
+            await pubsub.close()
+
+
+def make_events_handler(db_connection, secret_key):
+    class MoltinEventsHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            received_key = self.headers.get('X-Moltin-Secret-Key', '')
+            if secret_key and not hmac.compare_digest(
+                received_key.encode(), secret_key.encode()
+            ):
+                self.send_response(403)
+                self.end_headers()
+                return
+            try:
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                invalidation = parse_event(json.loads(body))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                logger.warning('Не удалось разобрать событие Moltin')
+                self.send_response(400)
+                self.end_headers()
+                return
+            try:
+                if invalidation:
+                    publish_invalidation(db_connection, invalidation)
+            except Exception:
+                logger.exception('Не удалось разослать сброс кэшей')
+                self.send_response(503)
+            else:
+                self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return MoltinEventsHandler
+
+
+def start_events_server(port, db_connection, secret_key=None):
+    """
+    Принимает вебхуки Moltin и рассылает по Redis, какие кэши сбросить.
+    Сами кэши сбрасывают подписчики, в том числе этот же процесс.
+    """
+    server = ThreadingHTTPServer(
+        ('0.0.0.0', port),
+        make_events_handler(db_connection, secret_key)
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
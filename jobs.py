@@ -0,0 +1,161 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+JOBS_DUE_KEY = 'jobs:due'
+JOBS_DATA_KEY = 'jobs:data'
+JOBS_ATTEMPTS_KEY = 'jobs:attempts'
+
+logger = logging.getLogger(__name__)
+
+SCHEDULE_SCRIPT = '''
+if redis.call('exists', KEYS[3]) == 1 then
+    return 0
+end
+if redis.call('hsetnx', KEYS[2], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('zadd', KEYS[1], ARGV[3], ARGV[1])
+return 1
+'''
+
+CLAIM_SCRIPT = '''
+local job_ids = redis.call(
+    'zrangebyscore', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2]
+)
+local claimed = {}
+for _, job_id in ipairs(job_ids) do
+    redis.call('zadd', KEYS[1], ARGV[3], job_id)
+    local attempts = redis.call('hincrby', KEYS[3], job_id, 1)
+    local job = redis.call('hget', KEYS[2], job_id)
+    if job then
+        table.insert(claimed, job_id)
+        table.insert(claimed, job)
+        table.insert(claimed, attempts)
+    else
+        redis.call('zrem', KEYS[1], job_id)
+        redis.call('hdel', KEYS[3], job_id)
+    end
+end
+return claimed
+'''
+
+
+class JobScheduler:
+    """
+    Отложенные задачи в Redis. Идентификаторы задач лежат в сортированном
+    множестве jobs:due с временем запуска, сами задачи — в хэше jobs:data.
+
+    Любой процесс забирает пачку созревших задач скриптом, который
+    сразу переносит их время на visibility_timeout вперёд. Задача
+    удаляется только после успешного выполнения, поэтому если процесс
+    упал, её заберёт другой — доставка «хотя бы один раз». Задачи пачки
+    выполняются в пуле из workers потоков. Задачу с тем же ключом
+    идемпотентности нельзя поставить повторно, пока она ждёт и ещё
+    done_ttl (или свой dedupe_ttl) после выполнения.
+    """
+
+    def __init__(self, db_connection, handlers, poll_interval=0.5,
+                 batch_size=100, visibility_timeout=60, max_attempts=5,
+                 done_ttl=24 * 60 * 60, workers=4):
+        self.db_connection = db_connection
+        self.handlers = handlers
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.done_ttl = done_ttl
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._schedule_script = db_connection.register_script(SCHEDULE_SCRIPT)
+        self._claim_script = db_connection.register_script(CLAIM_SCRIPT)
+        self._stopped = threading.Event()
+        self._poller = threading.Thread(
+            target=self._poll_forever,
+            daemon=True
+        )
+        self._poller.start()
+
+    @staticmethod
+    def get_done_key(job_id):
+        return f'jobs:done:{job_id}'
+
+    def schedule(self, job_type, payload, delay, idempotency_key=None,
+                 dedupe_ttl=None):
+        job_id = idempotency_key or uuid.uuid4().hex
+        return bool(self._schedule_script(
+            keys=[JOBS_DUE_KEY, JOBS_DATA_KEY, self.get_done_key(job_id)],
+            args=[
+                job_id,
+                json.dumps({
+                    'type': job_type,
+                    'payload': payload,
+                    'idempotent': idempotency_key is not None,
+                    'dedupe_ttl': dedupe_ttl,
+                }),
+                time.time() + delay,
+            ],
+        ))
+
+    def run_pending(self):
+        now = time.time()
+        claimed = self._claim_script(
+            keys=[JOBS_DUE_KEY, JOBS_DATA_KEY, JOBS_ATTEMPTS_KEY],
+            args=[now, self.batch_size, now + self.visibility_timeout],
+        )
+        jobs = []
+        finished = []
+        for position in range(0, len(claimed), 3):
+            job_id, raw_job, attempts = claimed[position:position + 3]
+            if attempts > self.max_attempts:
+                logger.error('Задача %s отброшена после %s попыток',
+                             job_id, attempts - 1)
+                finished.append((job_id, {}))
+            else:
+                jobs.append((job_id, json.loads(raw_job)))
+        succeeded = self._executor.map(self._run_job, jobs)
+        finished.extend(
+            job for job, success in zip(jobs, succeeded) if success
+        )
+
+        if finished:
+            job_ids = [job_id for job_id, _ in finished]
+            pipeline = self.db_connection.pipeline(transaction=False)
+            pipeline.zrem(JOBS_DUE_KEY, *job_ids)
+            pipeline.hdel(JOBS_DATA_KEY, *job_ids)
+            pipeline.hdel(JOBS_ATTEMPTS_KEY, *job_ids)
+            for job_id, job in finished:
+                if job.get('idempotent'):
+                    pipeline.set(
+                        self.get_done_key(job_id),
+                        1,
+                        ex=job.get('dedupe_ttl') or self.done_ttl
+                    )
+            pipeline.execute()
+        return len(claimed) // 3
+
+    def close(self):
+        self._stopped.set()
+        self._poller.join()
+        self._executor.shutdown()
+
+    def _run_job(self, job_item):
+        job_id, job = job_item
+        try:
+            self.handlers[job['type']](job['payload'])
+        except Exception:
+            logger.exception('Задача %s упала, будет повторена', job_id)
+            return False
+        return True
+
+    def _poll_forever(self):
+        while not self._stopped.is_set():
+            try:
+                claimed_count = self.run_pending()
+            except Exception:
+                logger.exception('Не удалось забрать задачи из Redis')
+                claimed_count = 0
+            if claimed_count < self.batch_size:
+                self._stopped.wait(self.poll_interval)
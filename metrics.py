@@ -0,0 +1,210 @@
+import bisect
+import logging
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (
+    .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10,
+)
+ID_PATTERN = re.compile(r'(/(?:products|files|carts|items|entries))/[^/]+')
+
+logger = logging.getLogger(__name__)
+
+
+class Histogram:
+    """Гистограмма в формате Prometheus с метками."""
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [
+                    [0] * (len(self.buckets) + 1), 0.0
+                ]
+            series[0][position] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.description}',
+            f'# TYPE {self.name} histogram',
+        ]
+        with self._lock:
+            series = [
+                (key, list(counts), total)
+                for key, (counts, total) in self._series.items()
+            ]
+        for key, counts, total in series:
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = format_labels(key + (('le', bucket),))
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(key)} {total}')
+            lines.append(
+                f'{self.name}_count{format_labels(key)} {cumulative}'
+            )
+        return lines
+
+
+class Gauge:
+    """Значения метрики берутся из функции в момент отдачи метрик."""
+
+    def __init__(self, name, description, collect):
+        self.name = name
+        self.description = description
+        self.collect = collect
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.description}',
+            f'# TYPE {self.name} gauge',
+        ]
+        for labels, value in self.collect():
+            lines.append(f'{self.name}{format_labels(labels)} {value}')
+        return lines
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    formatted_labels = ','.join(
+        f'{name}="{value}"' for name, value in labels
+    )
+    return f'{{{formatted_labels}}}'
+
+
+REGISTRY = []
+TRACES = deque(maxlen=50)
+TRACE_SAMPLE_RATE = 0
+READY = threading.Event()
+current_trace = threading.local()
+
+
+def register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+STATE_HANDLER_SECONDS = register(Histogram(
+    'tg_pizza_state_handler_seconds',
+    'Время работы обработчика состояния',
+))
+UPSTREAM_REQUEST_SECONDS = register(Histogram(
+    'tg_pizza_upstream_request_seconds',
+    'Время запроса к Moltin или геокодеру',
+))
+REDIS_COMMAND_SECONDS = register(Histogram(
+    'tg_pizza_redis_command_seconds',
+    'Время команды или пайплайна Redis',
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1),
+))
+BOT_API_SECONDS = register(Histogram(
+    'tg_pizza_bot_api_seconds',
+    'Время вызова метода Bot API',
+))
+
+
+def get_endpoint(path):
+    return ID_PATTERN.sub(r'\1/{id}', path)
+
+
+@contextmanager
+def timed(histogram, **labels):
+    """
+    Замеряет время блока. Если метка status осталась None, а блок упал,
+    в неё пишется имя исключения.
+    """
+    started_at = time.perf_counter()
+    try:
+        yield labels
+    except Exception as error:
+        if 'status' in labels and labels['status'] is None:
+            labels['status'] = type(error).__name__
+        raise
+    finally:
+        elapsed = time.perf_counter() - started_at
+        histogram.observe(elapsed, **labels)
+        trace = getattr(current_trace, 'spans', None)
+        if trace is not None:
+            trace.append((histogram.name, labels, started_at, elapsed))
+
+
+@contextmanager
+def traced(name):
+    """Если апдейт попал в выборку, копит и логирует его водопад вызовов."""
+    if random.random() >= TRACE_SAMPLE_RATE:
+        yield
+        return
+    current_trace.spans = []
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        spans, current_trace.spans = current_trace.spans, None
+        total = (time.perf_counter() - started_at) * 1000
+        lines = [f'{name}: {total:.1f} ms']
+        for metric_name, labels, span_started_at, elapsed in spans:
+            offset = (span_started_at - started_at) * 1000
+            lines.append(
+                f'  +{offset:7.1f} ms {elapsed * 1000:7.1f} ms '
+                f'{metric_name}{format_labels(sorted(labels.items()))}'
+            )
+        TRACES.append('\n'.join(lines))
+        logger.info('\n'.join(lines))
+
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = render_metrics()
+        elif self.path == '/traces':
+            body = '\n\n'.join(TRACES) + '\n'
+        elif self.path == '/ready':
+            self.send_response(200 if READY.is_set() else 503)
+            self.end_headers()
+            return
+        else:
+            self.send_response(404)
+            self.end_headers()
+            return
+        encoded_body = body.encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(encoded_body)))
+        self.end_headers()
+        self.wfile.write(encoded_body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port, trace_sample_rate=0):
+    global TRACE_SAMPLE_RATE
+
+    TRACE_SAMPLE_RATE = trace_sample_rate
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
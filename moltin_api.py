@@ -1,44 +1,250 @@
 import os
 import json
 import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from functools import partial
 from textwrap import dedent
+from urllib.parse import parse_qsl, urlparse
 
 import requests
 from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import Retry
 
-MOLTIN_TOKEN_EXPIRES_TIME = 0
-MOLTIN_TOKEN = None
+from breakers import get_breaker
+from deadlines import bind_deadline, get_deadline, get_timeout
+from metrics import UPSTREAM_REQUEST_SECONDS, get_endpoint, timed
 
+MOLTIN_API_URL = 'https://api.moltin.com'
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+PAGE_LIMIT = 100
+PAGE_PREFETCH = 4
 
-def get_access_token(client_id, client_secret):
-    global MOLTIN_TOKEN_EXPIRES_TIME
-    global MOLTIN_TOKEN
+MOLTIN_CLIENT = None
+MOLTIN_CLIENT_LOCK = threading.Lock()
 
-    if time.time() <= MOLTIN_TOKEN_EXPIRES_TIME:
-        return MOLTIN_TOKEN
+logger = logging.getLogger(__name__)
 
-    data = {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret,
-    }
-    response = requests.post('https://api.moltin.com/oauth/access_token', data=data)
-    response.raise_for_status()
-    decoded_response = response.json()
-    MOLTIN_TOKEN_EXPIRES_TIME = decoded_response.get('expires')
-    MOLTIN_TOKEN = decoded_response.get('access_token')
-    return MOLTIN_TOKEN
 
+class TokenManager:
+    """
+    OAuth-токен Moltin. Обновление идёт одним запросом за раз, остальные
+    потоки ждут его результата. Фоновый таймер обновляет токен заранее,
+    за refresh_margin секунд до истечения. Если передано подключение
+    к Redis, токен общий для всех процессов бота.
+    """
 
-def create_customer_entry(client_id, client_secret, chat_id, lat, lon):
-    access_token = get_access_token(client_id, client_secret)
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-    }
-    url = 'https://api.moltin.com/v2/flows/customer_address/entries'
-
-    data = {
+    def __init__(self, fetch_token, refresh_margin=5 * 60,
+                 db_connection=None, redis_key='moltin:access_token',
+                 retry_delay=30):
+        self.fetch_token = fetch_token
+        self.refresh_margin = refresh_margin
+        self.db_connection = db_connection
+        self.redis_key = redis_key
+        self.retry_delay = retry_delay
+        self.token = None
+        self.expires = 0
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def get_token(self):
+        if time.time() < self.expires:
+            return self.token
+        with self._lock:
+            if time.time() >= self.expires:
+                self._refresh()
+        return self.token
+
+    def _refresh(self):
+        if self.db_connection is None:
+            self._store(*self.fetch_token())
+            return
+        if self._adopt_shared_token():
+            return
+        lock = self.db_connection.lock(
+            f'{self.redis_key}:lock', timeout=30, blocking_timeout=30
+        )
+        with lock:
+            if self._adopt_shared_token():
+                return
+            token, expires = self.fetch_token()
+            self.db_connection.set(
+                self.redis_key,
+                json.dumps({'token': token, 'expires': expires}),
+                exat=int(expires)
+            )
+            self._store(token, expires)
+
+    def _adopt_shared_token(self):
+        shared_token = self.db_connection.get(self.redis_key)
+        if not shared_token:
+            return False
+        shared_token = json.loads(shared_token)
+        if shared_token['expires'] - self.refresh_margin <= time.time():
+            return False
+        self._store(shared_token['token'], shared_token['expires'])
+        return True
+
+    def _store(self, token, expires):
+        self.token = token
+        self.expires = expires
+        self._schedule_refresh(expires - self.refresh_margin - time.time())
+
+    def _schedule_refresh(self, delay):
+        if self._timer:
+            self._timer.cancel()
+        self._timer = threading.Timer(
+            max(delay, 0),
+            self._refresh_in_background
+        )
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            try:
+                self._refresh()
+            except Exception:
+                logger.exception('Не удалось обновить токен Moltin')
+                self._schedule_refresh(self.retry_delay)
+
+
+class DeadlineRetry(Retry):
+    """Не повторяет запрос, если пауза перед повтором не влезает в срок."""
+
+    def increment(self, method=None, url=None, response=None, error=None,
+                  _pool=None, _stacktrace=None):
+        retry = super().increment(
+            method, url, response, error, _pool, _stacktrace
+        )
+        deadline = get_deadline()
+        if deadline is None:
+            return retry
+        delay = retry.get_backoff_time()
+        if response is not None:
+            delay = max(delay, retry.get_retry_after(response) or 0)
+        if deadline.remaining <= delay:
+            raise MaxRetryError(_pool, url, error)
+        return retry
+
+
+class MoltinClient:
+    """
+    Клиент Moltin API с пулом keep-alive соединений.
+    Размер пула стоит делать не меньше числа потоков, которые делят
+    клиента, иначе они будут ждать свободное соединение.
+
+    Если задан hedge_after, GET-запрос, не ответивший за столько
+    секунд, дублируется, и берётся первый успешный ответ.
+    """
+
+    def __init__(self, client_id, client_secret, pool_size=10,
+                 timeout=(3.05, 10), retries=3, backoff_factor=0.3,
+                 base_url=MOLTIN_API_URL, db_connection=None,
+                 hedge_after=None):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.timeout = timeout
+        self.base_url = base_url
+        self.hedge_after = hedge_after
+        self._hedge_executor = None
+        if hedge_after is not None:
+            self._hedge_executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.breaker = get_breaker('moltin')
+        self.token_manager = TokenManager(
+            self.fetch_access_token,
+            db_connection=db_connection
+        )
+
+        retry = DeadlineRetry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            pool_block=True,
+            max_retries=retry,
+        )
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get_access_token(self):
+        return self.token_manager.get_token()
+
+    def fetch_access_token(self):
+        data = {
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+        }
+        with self.breaker.guard(), timed(
+            UPSTREAM_REQUEST_SECONDS,
+            upstream='moltin',
+            endpoint='/oauth/access_token',
+            status=None
+        ) as labels:
+            response = self.session.post(
+                f'{self.base_url}/oauth/access_token',
+                data=data,
+                timeout=get_timeout(self.timeout)
+            )
+            labels['status'] = response.status_code
+            response.raise_for_status()
+        decoded_response = response.json()
+        access_token = decoded_response.get('access_token')
+        return access_token, decoded_response.get('expires')
+
+    def request(self, method, path, **kwargs):
+        if method == 'GET' and self.hedge_after is not None:
+            return self._hedged_request(method, path, **kwargs)
+        return self._send(method, path, **kwargs)
+
+    def _hedged_request(self, method, path, **kwargs):
+        send = bind_deadline(partial(self._send, method, path, **kwargs))
+        attempts = [self._hedge_executor.submit(send)]
+        done, _ = wait(attempts, timeout=self.hedge_after)
+        if not done:
+            attempts.append(self._hedge_executor.submit(send))
+        error = None
+        for attempt in as_completed(attempts):
+            try:
+                return attempt.result()
+            except Exception as attempt_error:
+                error = attempt_error
+        raise error
+
+    def _send(self, method, path, **kwargs):
+        headers = {
+            'Authorization': f'Bearer {self.get_access_token()}',
+        }
+        headers.update(kwargs.pop('headers', {}))
+        kwargs['timeout'] = get_timeout(kwargs.get('timeout', self.timeout))
+        with self.breaker.guard(), timed(
+            UPSTREAM_REQUEST_SECONDS,
+            upstream='moltin',
+            endpoint=f'{method} {get_endpoint(path)}',
+            status=None
+        ) as labels:
+            response = self.session.request(
+                method,
+                f'{self.base_url}{path}',
+                headers=headers,
+                **kwargs
+            )
+            labels['status'] = response.status_code
+            response.raise_for_status()
+        return response
+
+    def create_customer_entry(self, chat_id, lat, lon):
+        data = {
             'data': {
                 'type': 'entry',
                 'chat_id': chat_id,
@@ -46,112 +252,171 @@ def create_customer_entry(client_id, client_secret, chat_id, lat, lon):
                 'lon': lon
             }
         }
-    response = requests.post(url, headers=headers, json=data)
-    response.raise_for_status()
+        self.request(
+            'POST', '/v2/flows/customer_address/entries', json=data
+        )
 
+    def add_product_to_cart(self, cart_id, product_id, quantity):
+        data = {
+            'data': {
+                'id': product_id,
+                'type': 'cart_item',
+                'quantity': quantity
+            }
+        }
+        self.request('POST', f'/v2/carts/{cart_id}/items', json=data)
 
-def add_product_to_cart(client_id, client_secret, cart_id, product_id, quantity):
-    access_token = get_access_token(client_id, client_secret)
-    url = f'https://api.moltin.com/v2/carts/{cart_id}/items'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-    }
-
-    data = {
-        'data': {
-            'id': product_id,
-            'type': 'cart_item',
-            'quantity': quantity
+    def remove_product_from_cart(self, cart_id, product_id):
+        response = self.request(
+            'DELETE', f'/v2/carts/{cart_id}/items/{product_id}'
+        )
+        return response.json()
+
+    def get_cart_products(self, cart_id):
+        return self.request('GET', f'/v2/carts/{cart_id}/items').json()
+
+    def get_cart_total(self, cart_id):
+        response = self.request('GET', f'/v2/carts/{cart_id}/')
+        return response.json()['data']['meta']['display_price']['with_tax']['formatted']
+
+    def get_page(self, path, limit=PAGE_LIMIT, offset=0, params=None):
+        params = {
+            **(params or {}),
+            'page[limit]': limit,
+            'page[offset]': offset,
         }
-    }
-    response = requests.post(url, headers=headers, json=data)
-    response.raise_for_status()
+        return self.request('GET', path, params=params).json()
 
+    def iter_pages(self, path, limit=PAGE_LIMIT, prefetch=PAGE_PREFETCH):
+        """
+        Страницы коллекции по одной. Из первой страницы берётся общее
+        число записей, остальные запрашиваются по смещениям, не больше
+        prefetch запросов одновременно. Если общего числа нет, обход
+        идёт по ссылкам links.next.
+        """
+        page = self.get_page(path, limit)
+        yield page
+        meta = page.get('meta') or {}
+        total = (meta.get('results') or {}).get('total')
+        if total is None:
+            yield from self._follow_next_links(page)
+            return
 
-def remove_product_from_cart(client_id, client_secret, cart_id, product_id):
-    access_token = get_access_token(client_id, client_secret)
-    url = f'https://api.moltin.com/v2/carts/{cart_id}/items/{product_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
+        limit = (meta.get('page') or {}).get('limit') or limit
+        with ThreadPoolExecutor(max_workers=prefetch) as executor:
+            pending_pages = deque()
+            for offset in range(limit, total, limit):
+                pending_pages.append(executor.submit(
+                    bind_deadline(self.get_page), path, limit, offset
+                ))
+                if len(pending_pages) >= prefetch:
+                    yield pending_pages.popleft().result()
+            while pending_pages:
+                yield pending_pages.popleft().result()
+
+    def iter_items(self, path, **kwargs):
+        for page in self.iter_pages(path, **kwargs):
+            yield from page['data']
+
+    def iter_products(self):
+        return self.iter_items('/pcm/products')
+
+    def iter_pizzerias(self, flow_slug='pizzeria'):
+        return self.iter_items(f'/v2/flows/{flow_slug}/entries')
+
+    def get_all_products(self):
+        return {'data': list(self.iter_products())}
+
+    def get_product_by_id(self, product_id):
+        return self.request('GET', f'/catalog/products/{product_id}').json()
+
+    def get_img_url(self, img_id):
+        response = self.request('GET', f'/v2/files/{img_id}')
+        return response.json()['data']['link']['href']
+
+    def get_all_pizzerias(self, flow_slug='pizzeria'):
+        return list(self.iter_pizzerias(flow_slug))
+
+    def _follow_next_links(self, page):
+        next_url = (page.get('links') or {}).get('next')
+        while page['data'] and next_url:
+            next_url = urlparse(next_url)
+            page = self.request(
+                'GET',
+                next_url.path,
+                params=dict(parse_qsl(next_url.query))
+            ).json()
+            yield page
+            next_url = (page.get('links') or {}).get('next')
+
+
+def configure_client(client_id, client_secret, **kwargs):
+    global MOLTIN_CLIENT
+
+    with MOLTIN_CLIENT_LOCK:
+        MOLTIN_CLIENT = MoltinClient(client_id, client_secret, **kwargs)
+    return MOLTIN_CLIENT
+
+
+def get_client(client_id, client_secret):
+    global MOLTIN_CLIENT
+
+    with MOLTIN_CLIENT_LOCK:
+        credentials = client_id, client_secret
+        if MOLTIN_CLIENT is None or \
+                (MOLTIN_CLIENT.client_id, MOLTIN_CLIENT.client_secret) != credentials:
+            MOLTIN_CLIENT = MoltinClient(client_id, client_secret)
+        return MOLTIN_CLIENT
 
-    response = requests.delete(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
+
+def get_access_token(client_id, client_secret):
+    return get_client(client_id, client_secret).get_access_token()
+
+
+def create_customer_entry(client_id, client_secret, chat_id, lat, lon):
+    client = get_client(client_id, client_secret)
+    client.create_customer_entry(chat_id, lat, lon)
+
+
+def add_product_to_cart(client_id, client_secret, cart_id, product_id, quantity):
+    client = get_client(client_id, client_secret)
+    client.add_product_to_cart(cart_id, product_id, quantity)
+
+
+def remove_product_from_cart(client_id, client_secret, cart_id, product_id):
+    client = get_client(client_id, client_secret)
+    return client.remove_product_from_cart(cart_id, product_id)
 
 
 def get_cart_products(client_id, client_secret, cart_id):
-    access_token = get_access_token(client_id, client_secret)
-    url = f'https://api.moltin.com/v2/carts/{cart_id}/items'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return get_client(client_id, client_secret).get_cart_products(cart_id)
 
 
 def get_cart_total(client_id, client_secret, cart_id):
-    access_token = get_access_token(client_id, client_secret)
-    url = f'https://api.moltin.com/v2/carts/{cart_id}/'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()['data']['meta']['display_price']['with_tax']['formatted']
+    return get_client(client_id, client_secret).get_cart_total(cart_id)
 
 
 def get_all_products(client_id, client_secret):
-    access_token = get_access_token(client_id, client_secret)
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    response = requests.get('https://api.moltin.com/pcm/products', headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return get_client(client_id, client_secret).get_all_products()
+
+
+def iter_products(client_id, client_secret):
+    return get_client(client_id, client_secret).iter_products()
 
 
 def get_product_by_id(client_id, client_secret, product_id):
-    access_token = get_access_token(client_id, client_secret)
-    url = f'https://api.moltin.com/catalog/products/{product_id}'
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
+    return get_client(client_id, client_secret).get_product_by_id(product_id)
 
 
 def get_img_url(client_id, client_secret, img_id):
-    access_token = get_access_token(client_id, client_secret)
+    return get_client(client_id, client_secret).get_img_url(img_id)
 
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    url = f'https://api.moltin.com/v2/files/{img_id}'
 
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()['data']['link']['href']
+def get_all_pizzerias(client_id, client_secret, flow_slug='pizzeria'):
+    client = get_client(client_id, client_secret)
+    return client.get_all_pizzerias(flow_slug)
 
 
-def get_all_pizzerias(client_id, client_secret, flow_slug='pizzeria'):
-    access_token = get_access_token(client_id, client_secret)
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-    }
-    url = f'https://api.moltin.com/v2/flows/{flow_slug}/entries'
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
-
-
-def get_deliveryman_id(client_id, client_secret, address):
-    pizzerias = get_all_pizzerias(client_id, client_secret)
-    for pizzeria in pizzerias:
-        if address == pizzeria['address']:
-            return pizzeria['chat_id']
+def iter_pizzerias(client_id, client_secret, flow_slug='pizzeria'):
+    client = get_client(client_id, client_secret)
+    return client.iter_pizzerias(flow_slug)
@@ -0,0 +1,62 @@
+import dataclasses
+from dataclasses import dataclass
+
+
+@dataclass(frozen=True)
+class OrderItem:
+    name: str
+    description: str
+    quantity: int
+    amount: int
+
+
+@dataclass(frozen=True)
+class Order:
+    """
+    Снимок заказа на момент нажатия «Заказать». Суммы хранятся в копейках.
+    Пиццерия, курьер и координаты клиента добавляются по ходу оформления
+    через dataclasses.replace; в сессии снимок лежит словарём.
+    """
+
+    items: tuple
+    total_amount: int
+    currency: str
+    customer_coords: tuple = None
+    pizzeria_id: str = None
+    pizzeria_address: str = None
+    distance: float = None
+    courier_id: int = None
+
+    def to_dict(self):
+        return dataclasses.asdict(self)
+
+    @classmethod
+    def from_dict(cls, order):
+        return cls(**{
+            **order,
+            'items': tuple(OrderItem(**item) for item in order['items']),
+            'customer_coords': order['customer_coords']
+            and tuple(order['customer_coords']),
+        })
+
+
+def build_order(cart_products):
+    items = tuple(
+        OrderItem(
+            name=product['name'],
+            description=product['description'].strip(),
+            quantity=product['quantity'],
+            amount=product['meta']['display_price']['with_tax']['value']['amount'],
+        )
+        for product in cart_products['data']
+    )
+    total_price = cart_products['meta']['display_price']['with_tax']
+    return Order(
+        items=items,
+        total_amount=total_price['amount'],
+        currency=total_price.get('currency', 'RUB'),
+    )
+
+
+def format_amount(amount):
+    return f'{amount // 100}.{amount % 100:02d}'
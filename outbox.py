@@ -0,0 +1,184 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from caches import LRUCache
+
+PRIORITY_URGENT = 0
+PRIORITY_UI = 1
+PRIORITY_DEFERRED = 2
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def get_delay(self, now):
+        self.tokens = min(
+            self.capacity,
+            self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class OutboxJob:
+    def __init__(self, priority, method, chat_id, kwargs, callback):
+        self.priority = priority
+        self.method = method
+        self.chat_id = chat_id
+        self.kwargs = kwargs
+        self.callback = callback
+        self.future = Future()
+
+
+class Outbox:
+    """
+    Очередь исходящих вызовов Bot API. Отправка идёт в фоне с учётом
+    общего лимита Telegram и лимита на чат. Вызовы одного чата
+    выполняются строго по порядку отправки: в очереди с приоритетами
+    стоит только первый из них, остальные ждут в _blocked. Поэтому
+    приоритет действует между чатами: срочные сообщения (заказы
+    курьерам) уходят раньше обновлений интерфейса в других чатах, а
+    отложенные — последними. На RetryAfter вызов повторяется после
+    указанной паузы, а следующие вызовы этого чата ждут его.
+    """
+
+    def __init__(self, bot, workers=4, global_rate=30, chat_rate=1,
+                 chat_burst=3, max_chats=10000):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = LRUCache(max_chats)
+        self._ready = []
+        self._delayed = []
+        self._blocked = defaultdict(deque)
+        self._active_chats = set()
+        self._pending_count = 0
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._stopped = False
+        self._scheduler = threading.Thread(target=self._schedule, daemon=True)
+        self._scheduler.start()
+
+    def send(self, priority, method, callback=None, **kwargs):
+        job = OutboxJob(priority, method, kwargs.get('chat_id'), kwargs, callback)
+        with self._condition:
+            self._pending_count += 1
+            if job.chat_id in self._active_chats:
+                self._blocked[job.chat_id].append(job)
+                return job.future
+            self._active_chats.add(job.chat_id)
+            self._push_ready(job)
+            self._condition.notify()
+        return job.future
+
+    def wait_idle(self, timeout=None):
+        deadline = timeout and time.monotonic() + timeout
+        with self._condition:
+            while self._pending_count:
+                remaining = deadline and deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout=5):
+        self.wait_idle(timeout)
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._scheduler.join()
+        self._executor.shutdown()
+
+    def _push_ready(self, job):
+        heapq.heappush(self._ready, (job.priority, next(self._sequence), job))
+
+    def _push_delayed(self, job, delay):
+        ready_at = time.monotonic() + delay
+        heapq.heappush(self._delayed, (ready_at, next(self._sequence), job))
+
+    def _get_chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets.set(chat_id, bucket)
+        return bucket
+
+    def _schedule(self):
+        with self._condition:
+            while not self._stopped:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    self._push_ready(heapq.heappop(self._delayed)[2])
+                if not self._ready:
+                    timeout = self._delayed and self._delayed[0][0] - now
+                    self._condition.wait(timeout or None)
+                    continue
+
+                job = heapq.heappop(self._ready)[2]
+                chat_bucket = self._get_chat_bucket(job.chat_id)
+                chat_delay = chat_bucket.get_delay(now)
+                if chat_delay:
+                    self._push_delayed(job, chat_delay)
+                    continue
+                global_delay = self._global_bucket.get_delay(now)
+                if global_delay:
+                    self._push_ready(job)
+                    self._condition.wait(global_delay)
+                    continue
+
+                chat_bucket.take()
+                self._global_bucket.take()
+                self._executor.submit(self._execute, job)
+
+    def _execute(self, job):
+        from telegram.error import RetryAfter
+
+        retry_after = None
+        try:
+            result = getattr(self.bot, job.method)(**job.kwargs)
+        except RetryAfter as error:
+            logger.warning('Telegram просит подождать %s с', error.retry_after)
+            retry_after = error.retry_after
+        except Exception as error:
+            logger.exception('Не удалось выполнить %s', job.method)
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
+            if job.callback:
+                try:
+                    job.callback(result)
+                except Exception:
+                    logger.exception('Ошибка в обработчике результата')
+
+        with self._condition:
+            if retry_after is not None:
+                self._push_delayed(job, retry_after)
+                self._condition.notify_all()
+                return
+            self._pending_count -= 1
+            blocked = self._blocked.get(job.chat_id)
+            if blocked:
+                self._push_ready(blocked.popleft())
+                if not blocked:
+                    del self._blocked[job.chat_id]
+            else:
+                self._active_chats.discard(job.chat_id)
+            self._condition.notify_all()
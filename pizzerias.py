@@ -0,0 +1,144 @@
+import heapq
+import math
+import threading
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def to_unit_vector(lat, lon):
+    lat, lon = math.radians(float(lat)), math.radians(float(lon))
+    return (
+        math.cos(lat) * math.cos(lon),
+        math.cos(lat) * math.sin(lon),
+        math.sin(lat),
+    )
+
+
+def chord_to_km(squared_chord):
+    chord = math.sqrt(squared_chord)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(chord / 2, 1))
+
+
+def build_tree(points, depth=0):
+    if not points:
+        return None
+    axis = depth % 3
+    points.sort(key=lambda point: point[0][axis])
+    median = len(points) // 2
+    vector, position = points[median]
+    return (
+        vector,
+        position,
+        axis,
+        build_tree(points[:median], depth + 1),
+        build_tree(points[median + 1:], depth + 1),
+    )
+
+
+def search_tree(node, target, k, heap):
+    if node is None:
+        return
+    vector, position, axis, left, right = node
+    squared_chord = sum((a - b) ** 2 for a, b in zip(vector, target))
+    if len(heap) < k:
+        heapq.heappush(heap, (-squared_chord, position))
+    elif squared_chord < -heap[0][0]:
+        heapq.heapreplace(heap, (-squared_chord, position))
+
+    diff = target[axis] - vector[axis]
+    near, far = (left, right) if diff < 0 else (right, left)
+    search_tree(near, target, k, heap)
+    if len(heap) < k or diff ** 2 < -heap[0][0]:
+        search_tree(far, target, k, heap)
+
+
+def get_fingerprint(pizzerias):
+    return hash(tuple(
+        (
+            pizzeria['id'], pizzeria['lat'], pizzeria['lon'],
+            pizzeria['address'], pizzeria.get('chat_id'),
+        )
+        for pizzeria in pizzerias
+    ))
+
+
+class PizzeriaRegistry:
+    """
+    Пиццерии из flow, проиндексированные по id записи, адресу и chat_id
+    курьера, плюс KD-дерево по координатам на единичной сфере.
+    Хорда на сфере монотонна расстоянию по дуге, поэтому дерево даёт
+    точный порядок кандидатов, а geodesic считается только для них.
+    Если передана сетка зон доставки, ближайшая пиццерия сначала ищется
+    в ней.
+    """
+
+    def __init__(self, delivery_zones=None):
+        self.delivery_zones = delivery_zones
+        self.fingerprint = None
+        self._snapshot = [], None
+        self.by_id = {}
+        self.by_address = {}
+        self.by_courier = {}
+        self._lock = threading.Lock()
+
+    @property
+    def pizzerias(self):
+        return self._snapshot[0]
+
+    def get_courier_id(self, pizzeria_id):
+        """None, если пиццерии нет или у неё не указан chat_id курьера."""
+        pizzeria = self.by_id.get(pizzeria_id)
+        return pizzeria and pizzeria.get('chat_id')
+
+    def update(self, pizzerias):
+        pizzerias = list(pizzerias)
+        fingerprint = get_fingerprint(pizzerias)
+        with self._lock:
+            if fingerprint == self.fingerprint:
+                return False
+            points = [
+                (to_unit_vector(pizzeria['lat'], pizzeria['lon']), position)
+                for position, pizzeria in enumerate(pizzerias)
+            ]
+            self._snapshot = pizzerias, build_tree(points)
+            self.by_id = {pizzeria['id']: pizzeria for pizzeria in pizzerias}
+            self.by_address = {
+                pizzeria['address']: pizzeria for pizzeria in pizzerias
+            }
+            self.by_courier = {
+                pizzeria['chat_id']: pizzeria
+                for pizzeria in pizzerias if pizzeria.get('chat_id')
+            }
+            if self.delivery_zones:
+                self.delivery_zones.update(pizzerias)
+            self.fingerprint = fingerprint
+        return True
+
+    def nearest(self, coords, k=1):
+        pizzerias, tree = self._snapshot
+        heap = []
+        search_tree(tree, to_unit_vector(*coords), k, heap)
+        return [
+            (chord_to_km(-squared_chord), pizzerias[position])
+            for squared_chord, position in sorted(heap, reverse=True)
+        ]
+
+    def find_nearest(self, coords, candidates=3):
+        from geopy import distance
+
+        coords = tuple(float(coordinate) for coordinate in coords)
+        if self.delivery_zones:
+            quote = self.delivery_zones.lookup(coords)
+            pizzeria = quote and self.by_id.get(quote[1])
+            if pizzeria:
+                return quote[0], pizzeria
+        nearest = []
+        for _, pizzeria in self.nearest(coords, k=candidates):
+            pizzeria_coords = float(pizzeria['lat']), float(pizzeria['lon'])
+            nearest.append((
+                distance.distance(pizzeria_coords, coords).km,
+                pizzeria
+            ))
+        if not nearest:
+            return None
+        return min(nearest, key=lambda item: item[0])
@@ -0,0 +1,90 @@
+import hashlib
+import json
+
+API_METHODS = {
+    'send_message': 'sendMessage',
+    'send_photo': 'sendPhoto',
+    'delete_message': 'deleteMessage',
+    'edit_message_text': 'editMessageText',
+    'edit_message_media': 'editMessageMedia',
+    'edit_message_reply_markup': 'editMessageReplyMarkup',
+}
+
+
+def get_hash(value):
+    dumped_value = json.dumps(value, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(dumped_value.encode()).hexdigest()[:16]
+
+
+def plan_screen(last_screen, chat_id, message_id, message_kind, text,
+                reply_markup=None, photo=None, photo_key=None):
+    """
+    Решает, как показать экран в чате. Экран — текст или фото с подписью
+    и клавиатурой. message_id и message_kind описывают сообщение, на
+    кнопку которого нажал пользователь, last_screen — запись о последнем
+    показанном экране из сессии.
+
+    Сообщение того же типа с inline-клавиатурой редактируется на месте,
+    причём если изменилась только клавиатура — одной её правкой. Если
+    экран не изменился, вызовов нет совсем. Новое сообщение (и удаление
+    старого) нужно, только когда меняется тип сообщения или клавиатура
+    не inline. photo_key отличает фото, если photo — это file_id или ссылка,
+    которые меняются от раза к разу. Если id последнего экрана
+    неизвестен — он ушёл новым сообщением, и ответа на отправку бот не
+    ждал, — нажатое сообщение считается этим экраном.
+
+    Возвращает список вызовов Bot API (метод, аргументы) и новую запись
+    для сессии.
+    """
+    from telegram import InlineKeyboardMarkup, InputMediaPhoto
+
+    kind = 'photo' if photo else 'text'
+    screen = {
+        'message_id': message_id,
+        'kind': kind,
+        'content_hash': get_hash([kind, text, photo_key or photo]),
+        'markup_hash': get_hash(reply_markup and reply_markup.to_dict()),
+    }
+    editable = message_id is not None and message_kind == kind and (
+        reply_markup is None or isinstance(reply_markup, InlineKeyboardMarkup)
+    )
+    if not editable:
+        if photo:
+            send = ('send_photo', {
+                'chat_id': chat_id,
+                'photo': photo,
+                'caption': text,
+                'reply_markup': reply_markup,
+            })
+        else:
+            send = ('send_message', {
+                'chat_id': chat_id,
+                'text': text,
+                'reply_markup': reply_markup,
+            })
+        calls = [send]
+        if message_id is not None:
+            calls.append(('delete_message', {
+                'chat_id': chat_id,
+                'message_id': message_id,
+            }))
+        screen['message_id'] = None
+        return calls, screen
+
+    if not last_screen or last_screen['message_id'] not in (message_id, None):
+        last_screen = {}
+    edit_args = {
+        'chat_id': chat_id,
+        'message_id': message_id,
+        'reply_markup': reply_markup,
+    }
+    if last_screen.get('content_hash') != screen['content_hash']:
+        if photo:
+            return [('edit_message_media', {
+                **edit_args,
+                'media': InputMediaPhoto(photo, caption=text),
+            })], screen
+        return [('edit_message_text', {**edit_args, 'text': text})], screen
+    if last_screen.get('markup_hash') != screen['markup_hash']:
+        return [('edit_message_reply_markup', edit_args)], screen
+    return [], screen
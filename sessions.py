@@ -0,0 +1,319 @@
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from caches import LRUCache
+
+logger = logging.getLogger(__name__)
+
+ACQUIRE_SCRIPT = '''
+local owner_id = redis.call('get', KEYS[1])
+if not owner_id or owner_id == ARGV[1] then
+    redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+    return ARGV[1]
+end
+return owner_id
+'''
+
+WRITE_SCRIPT = '''
+if ARGV[1] ~= '' then
+    if redis.call('get', KEYS[1]) ~= ARGV[1] then
+        return 0
+    end
+    if (redis.call('get', KEYS[4]) or '0') ~= ARGV[6] then
+        return 0
+    end
+    redis.call('pexpire', KEYS[1], ARGV[4])
+end
+if ARGV[2] ~= '' then
+    redis.call('set', KEYS[2], ARGV[2], 'EX', ARGV[3])
+else
+    redis.call('expire', KEYS[2], ARGV[3])
+end
+for field, value in pairs(cjson.decode(ARGV[5])) do
+    redis.call('hset', KEYS[3], field, value)
+end
+redis.call('expire', KEYS[3], ARGV[3])
+local version = redis.call('incr', KEYS[4])
+redis.call('expire', KEYS[4], ARGV[3])
+return version
+'''
+
+
+class Session:
+    """Данные разговора с одним чатом. Запоминает, какие поля изменились."""
+
+    def __init__(self, chat_id, data=None):
+        self.chat_id = chat_id
+        self.data = data or {}
+        self.changed = set()
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.changed.add(key)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+
+class SessionStore:
+    """
+    Состояние чата лежит в ключе chat_id, данные сессии — в хэше
+    session:<chat_id>. Оба читаются и пишутся одним пайплайном.
+
+    Каждая запись увеличивает счётчик version:<chat_id>.
+
+    Процесс, взявший в Redis аренду owner:<chat_id>, держит состояние
+    и сессию чата в локальном кэше, пока аренда свежая, и читает из
+    Redis только счётчик версии: если чат с тех пор записал кто-то
+    другой, копия перечитывается. Записи владельца копятся и раз в
+    flush_interval уходят одним пайплайном; скрипт записи проверяет
+    аренду и версию. Если проверка не прошла, изменения не теряются,
+    а записываются поверх новых данных, и копия сбрасывается. Если
+    чатом владеет другой процесс, чтение и запись идут напрямую.
+    """
+
+    def __init__(self, db_connection, idle_ttl=24 * 60 * 60,
+                 lease_ttl=60, flush_interval=0.2, maxsize=10000):
+        self.db_connection = db_connection
+        self.idle_ttl = idle_ttl
+        self.lease_ttl = lease_ttl
+        self.flush_interval = flush_interval
+        self.owner_id = ':'.join(
+            [socket.gethostname(), str(os.getpid()), uuid.uuid4().hex[:8]]
+        )
+        self._local = LRUCache(maxsize)
+        self._pending = {}
+        self._flushing = set()
+        self._lock = threading.Lock()
+        self._flushed = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._acquire_script = db_connection.register_script(ACQUIRE_SCRIPT)
+        self._write_script = db_connection.register_script(WRITE_SCRIPT)
+        self._stopped = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_forever,
+            daemon=True
+        )
+        self._flusher.start()
+
+    @staticmethod
+    def get_session_key(chat_id):
+        return f'session:{chat_id}'
+
+    @staticmethod
+    def get_owner_key(chat_id):
+        return f'owner:{chat_id}'
+
+    @staticmethod
+    def get_version_key(chat_id):
+        return f'version:{chat_id}'
+
+    def load(self, chat_id):
+        entry = self._local.get(chat_id)
+        lease_left = entry and entry['lease_expires'] - time.monotonic()
+        if lease_left and lease_left > self.lease_ttl / 2:
+            version = self.db_connection.get(self.get_version_key(chat_id))
+            if (version or '0') == entry['version']:
+                return entry['state'], Session(chat_id, dict(entry['data']))
+
+        self._wait_flushed(chat_id)
+        pipeline = self.db_connection.pipeline(transaction=False)
+        self._acquire_script(
+            keys=[self.get_owner_key(chat_id)],
+            args=[self.owner_id, self.lease_ttl],
+            client=pipeline,
+        )
+        pipeline.get(chat_id)
+        pipeline.hgetall(self.get_session_key(chat_id))
+        pipeline.get(self.get_version_key(chat_id))
+        owner_id, state, raw_session, version = pipeline.execute()
+        session_data = {
+            key: json.loads(value) for key, value in raw_session.items()
+        }
+        if owner_id == self.owner_id:
+            self._local.set(chat_id, {
+                'state': state,
+                'data': dict(session_data),
+                'version': version or '0',
+                'lease_expires': time.monotonic() + self.lease_ttl,
+            })
+        else:
+            self._local.pop(chat_id)
+        return state, Session(chat_id, session_data)
+
+    def save(self, chat_id, state, session):
+        changes = {key: session[key] for key in session.changed}
+        session.changed.clear()
+        entry = self._local.get(chat_id)
+        if entry is None:
+            self._write(chat_id, state, changes)
+            return
+
+        if state:
+            entry['state'] = state
+        entry['data'].update(changes)
+        self._add_pending(chat_id, state, changes)
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._flushing = set(pending)
+            try:
+                self._flush_pending(pending)
+            finally:
+                with self._lock:
+                    self._flushing = set()
+                    self._flushed.notify_all()
+
+    def _flush_pending(self, pending):
+        if not pending:
+            return
+
+        entries = {chat_id: self._local.get(chat_id) for chat_id in pending}
+        pipeline = self.db_connection.pipeline(transaction=False)
+        for chat_id, (state, changes) in pending.items():
+            self._call_write_script(
+                chat_id, state, changes, pipeline, entries[chat_id]
+            )
+        try:
+            results = pipeline.execute()
+        except Exception:
+            for chat_id, (state, changes) in pending.items():
+                self._add_pending(chat_id, state, changes, newer=False)
+            raise
+
+        lease_expires = time.monotonic() + self.lease_ttl
+        conflicts = {}
+        for chat_id, version in zip(pending, results):
+            entry = entries[chat_id]
+            if not version:
+                logger.warning('Чат %s изменён другим процессом', chat_id)
+                self._local.pop(chat_id)
+                conflicts[chat_id] = pending[chat_id]
+            elif entry:
+                entry['version'] = str(version)
+                entry['lease_expires'] = lease_expires
+        if conflicts:
+            self._flush_pending(conflicts)
+
+    def close(self):
+        self._stopped.set()
+        self._flusher.join()
+        self.flush()
+
+    def _add_pending(self, chat_id, state, changes, newer=True):
+        with self._lock:
+            pending_state, pending_changes = \
+                self._pending.get(chat_id, (None, {}))
+            if newer:
+                self._pending[chat_id] = (
+                    state or pending_state,
+                    {**pending_changes, **changes},
+                )
+            else:
+                self._pending[chat_id] = (
+                    pending_state or state,
+                    {**changes, **pending_changes},
+                )
+
+    def _wait_flushed(self, chat_id):
+        """
+        Дожидается, пока отложенные записи чата дойдут до Redis, чтобы
+        не прочитать его в промежутке между сменой _pending и пайплайном.
+        """
+        with self._lock:
+            while chat_id in self._flushing:
+                self._flushed.wait()
+            has_pending = chat_id in self._pending
+        if has_pending:
+            self.flush()
+
+    def _call_write_script(self, chat_id, state, changes, client,
+                           entry=None):
+        """
+        С entry пишет от имени владельца и только поверх той версии,
+        которую видела копия; без entry пишет безусловно.
+        """
+        return self._write_script(
+            keys=[
+                self.get_owner_key(chat_id),
+                chat_id,
+                self.get_session_key(chat_id),
+                self.get_version_key(chat_id),
+            ],
+            args=[
+                self.owner_id if entry else '',
+                state or '',
+                self.idle_ttl,
+                self.lease_ttl * 1000,
+                json.dumps({
+                    key: json.dumps(value)
+                    for key, value in changes.items()
+                }),
+                entry['version'] if entry else '',
+            ],
+            client=client,
+        )
+
+    def _write(self, chat_id, state, changes):
+        self._call_write_script(chat_id, state, changes, self.db_connection)
+
+    def _flush_forever(self):
+        while not self._stopped.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Не удалось записать сессии в Redis')
+
+
+class AsyncSessionStore:
+    """
+    Хранилище для асинхронного бота поверх redis.asyncio. Ключи те же,
+    что у SessionStore, но без локального кэша: состояние и сессия
+    читаются и пишутся одним пайплайном на апдейт. Запись тоже
+    увеличивает version:<chat_id>, чтобы копии SessionStore устарели.
+    """
+
+    def __init__(self, db_connection, idle_ttl=24 * 60 * 60):
+        self.db_connection = db_connection
+        self.idle_ttl = idle_ttl
+
+    async def load(self, chat_id):
+        pipeline = self.db_connection.pipeline(transaction=False)
+        pipeline.get(chat_id)
+        pipeline.hgetall(SessionStore.get_session_key(chat_id))
+        state, raw_session = await pipeline.execute()
+        session_data = {
+            key: json.loads(value) for key, value in raw_session.items()
+        }
+        return state, Session(chat_id, session_data)
+
+    async def save(self, chat_id, state, session):
+        session_key = SessionStore.get_session_key(chat_id)
+        pipeline = self.db_connection.pipeline(transaction=False)
+        if state:
+            pipeline.set(chat_id, state, ex=self.idle_ttl)
+        else:
+            pipeline.expire(chat_id, self.idle_ttl)
+        if session.changed:
+            pipeline.hset(session_key, mapping={
+                key: json.dumps(session[key]) for key in session.changed
+            })
+            session.changed.clear()
+        pipeline.expire(session_key, self.idle_ttl)
+        version_key = SessionStore.get_version_key(chat_id)
+        pipeline.incr(version_key)
+        pipeline.expire(version_key, self.idle_ttl)
+        await pipeline.execute()
@@ -0,0 +1,39 @@
+import asyncio
+import time
+import unittest
+
+from breakers import CLOSED, OPEN, CircuitBreaker, CircuitOpenError
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def trip(self, breaker):
+        for _ in range(breaker.min_calls):
+            with self.assertRaises(ConnectionError):
+                with breaker.guard():
+                    raise ConnectionError()
+        self.assertEqual(breaker.state, OPEN)
+
+    def test_cancelled_probe_reopens_and_recovers(self):
+        breaker = CircuitBreaker('test', min_calls=2, reset_timeout=.05)
+        self.trip(breaker)
+        time.sleep(.06)
+
+        async def slow_probe():
+            with breaker.guard():
+                await asyncio.sleep(1)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(slow_probe(), .01))
+        self.assertEqual(breaker.state, OPEN)
+        with self.assertRaises(CircuitOpenError):
+            with breaker.guard():
+                pass
+
+        time.sleep(.06)
+        with breaker.guard():
+            pass
+        self.assertEqual(breaker.state, CLOSED)
+
+
+if __name__ == '__main__':
+    unittest.main()
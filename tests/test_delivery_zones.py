@@ -0,0 +1,94 @@
+import os
+import random
+import tempfile
+import unittest
+
+from geopy import distance
+
+from delivery_zones import BOUNDARY, DeliveryZones, get_tier
+
+
+def get_pizzerias(count, seed):
+    generator = random.Random(seed)
+    return [
+        {
+            'id': f'pizzeria-{number}',
+            'lat': 55.6 + generator.random() * .3,
+            'lon': 37.4 + generator.random() * .4,
+        }
+        for number in range(count)
+    ]
+
+
+def find_nearest(pizzerias, coords):
+    return min(
+        (distance.distance((pizzeria['lat'], pizzeria['lon']), coords).km,
+         pizzeria['id'])
+        for pizzeria in pizzerias
+    )
+
+
+class DeliveryZonesTest(unittest.TestCase):
+    def setUp(self):
+        self.generator = random.Random(7)
+
+    def assert_matches_geodesic(self, zones, pizzerias, samples=400):
+        found_count = 0
+        for _ in range(samples):
+            coords = (
+                55.3 + self.generator.random() * .9,
+                36.9 + self.generator.random() * 1.4,
+            )
+            nearest_km, nearest_id = find_nearest(pizzerias, coords)
+            found = zones.lookup(coords)
+            if found is None:
+                grid = zones.grid
+                cell = grid.cells.get(
+                    zones._get_cell(coords, grid.origin, grid.steps)
+                )
+                if cell is not None:
+                    self.assertEqual(cell, (BOUNDARY, ()))
+                else:
+                    self.assertGreater(nearest_km, 19.9)
+                continue
+            found_count += 1
+            distance_km, pizzeria_id = found
+            self.assertEqual(pizzeria_id, nearest_id, coords)
+            self.assertEqual(get_tier(distance_km), get_tier(nearest_km),
+                             coords)
+            self.assertAlmostEqual(distance_km, nearest_km, delta=.1)
+        self.assertGreater(found_count, samples // 4)
+
+    def test_lookup_matches_geodesic_search(self):
+        pizzerias = get_pizzerias(10, seed=1)
+        zones = DeliveryZones(cell_km=1)
+        zones.update(pizzerias, wait=True)
+        self.assert_matches_geodesic(zones, pizzerias)
+
+    def test_lookup_after_incremental_add(self):
+        pizzerias = get_pizzerias(12, seed=2)
+        zones = DeliveryZones(cell_km=1)
+        zones.update(pizzerias[:10], wait=True)
+        previous_grid = zones.grid
+        zones.update(pizzerias, wait=True)
+        # Дополненная сетка сохраняет начало и шаг прежней.
+        self.assertEqual(zones.grid.origin, previous_grid.origin)
+        self.assertEqual(zones.grid.steps, previous_grid.steps)
+        self.assertEqual(len(zones.grid.pizzeria_ids), 12)
+        self.assert_matches_geodesic(zones, pizzerias)
+
+    def test_saved_grid_is_loaded(self):
+        pizzerias = get_pizzerias(10, seed=3)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'zones.bin')
+            zones = DeliveryZones(path, cell_km=1)
+            zones.update(pizzerias, wait=True)
+
+            loaded_zones = DeliveryZones(path, cell_km=1)
+            loaded_zones.update(pizzerias)
+            self.assertEqual(loaded_zones.fingerprint, zones.fingerprint)
+            self.assertEqual(loaded_zones.grid, zones.grid)
+
+
+if __name__ == '__main__':
+    unittest.main()
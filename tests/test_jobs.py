@@ -0,0 +1,100 @@
+import unittest
+
+import fakeredis
+
+from jobs import JOBS_ATTEMPTS_KEY, JOBS_DATA_KEY, JOBS_DUE_KEY, JobScheduler
+
+
+class JobSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.db_connection = fakeredis.FakeRedis(decode_responses=True)
+        self.payloads = []
+        self.failures = 0
+
+    def handle(self, payload):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError()
+        self.payloads.append(payload)
+
+    def make_scheduler(self, **kwargs):
+        scheduler = JobScheduler(
+            self.db_connection, {'test': self.handle}, **kwargs
+        )
+        # Задачи забирает сам тест, фоновый опрос не нужен.
+        scheduler._stopped.set()
+        scheduler._poller.join()
+        self.addCleanup(scheduler.close)
+        return scheduler
+
+    def test_claims_only_due_jobs(self):
+        scheduler = self.make_scheduler()
+        scheduler.schedule('test', {'chat_id': 1}, 0)
+        scheduler.schedule('test', {'chat_id': 2}, 60)
+
+        self.assertEqual(scheduler.run_pending(), 1)
+        self.assertEqual(self.payloads, [{'chat_id': 1}])
+        self.assertEqual(self.db_connection.zcard(JOBS_DUE_KEY), 1)
+        self.assertEqual(self.db_connection.hlen(JOBS_DATA_KEY), 1)
+        self.assertEqual(scheduler.run_pending(), 0)
+
+    def test_failed_job_is_hidden_for_visibility_timeout(self):
+        scheduler = self.make_scheduler(visibility_timeout=60)
+        scheduler.schedule('test', {'chat_id': 1}, 0)
+        self.failures = 1
+
+        self.assertEqual(scheduler.run_pending(), 1)
+        self.assertEqual(scheduler.run_pending(), 0)
+        self.assertEqual(self.payloads, [])
+        self.assertEqual(self.db_connection.zcard(JOBS_DUE_KEY), 1)
+
+    def test_failed_job_is_retried(self):
+        scheduler = self.make_scheduler(visibility_timeout=0)
+        scheduler.schedule('test', {'chat_id': 1}, 0)
+        self.failures = 2
+
+        for _ in range(3):
+            scheduler.run_pending()
+        self.assertEqual(self.payloads, [{'chat_id': 1}])
+        self.assertEqual(self.db_connection.zcard(JOBS_DUE_KEY), 0)
+        self.assertEqual(self.db_connection.hlen(JOBS_ATTEMPTS_KEY), 0)
+
+    def test_job_is_dropped_after_max_attempts(self):
+        scheduler = self.make_scheduler(visibility_timeout=0, max_attempts=2)
+        scheduler.schedule('test', {'chat_id': 1}, 0, idempotency_key='k')
+        self.failures = 10
+
+        for _ in range(3):
+            self.assertEqual(scheduler.run_pending(), 1)
+        self.assertEqual(self.failures, 8)
+        self.assertEqual(scheduler.run_pending(), 0)
+        self.assertEqual(self.db_connection.zcard(JOBS_DUE_KEY), 0)
+        self.assertEqual(self.db_connection.hlen(JOBS_DATA_KEY), 0)
+        self.assertEqual(self.db_connection.hlen(JOBS_ATTEMPTS_KEY), 0)
+
+    def test_idempotency_key_deduplicates(self):
+        scheduler = self.make_scheduler(done_ttl=60)
+        self.assertTrue(scheduler.schedule('test', {'n': 1}, 0, 'key'))
+        self.assertFalse(scheduler.schedule('test', {'n': 2}, 0, 'key'))
+
+        scheduler.run_pending()
+        self.assertFalse(scheduler.schedule('test', {'n': 3}, 0, 'key'))
+        self.assertEqual(self.payloads, [{'n': 1}])
+        self.assertLessEqual(
+            self.db_connection.ttl(JobScheduler.get_done_key('key')), 60
+        )
+
+        self.assertTrue(scheduler.schedule('test', {'n': 4}, 0))
+        self.assertTrue(scheduler.schedule('test', {'n': 5}, 0))
+
+    def test_dedupe_ttl_overrides_done_ttl(self):
+        scheduler = self.make_scheduler(done_ttl=3600)
+        scheduler.schedule('test', {}, 0, 'key', dedupe_ttl=5)
+        scheduler.run_pending()
+        self.assertLessEqual(
+            self.db_connection.ttl(JobScheduler.get_done_key('key')), 5
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import unittest
+
+from telegram import (
+    InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton,
+    ReplyKeyboardMarkup
+)
+
+from screens import plan_screen
+
+
+def make_markup(callback_data):
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton('Кнопка', callback_data=callback_data)]]
+    )
+
+
+class PlanScreenTest(unittest.TestCase):
+    def get_methods(self, calls):
+        return [method for method, _ in calls]
+
+    def test_typed_message_gets_new_screen(self):
+        calls, screen = plan_screen(None, 1, None, None, 'Меню')
+        self.assertEqual(self.get_methods(calls), ['send_message'])
+        self.assertIsNone(screen['message_id'])
+
+    def test_kind_change_sends_and_deletes(self):
+        calls, screen = plan_screen(
+            None, 1, 5, 'text', 'Пицца', make_markup('a'), photo='F'
+        )
+        self.assertEqual(
+            self.get_methods(calls), ['send_photo', 'delete_message']
+        )
+        self.assertEqual(calls[1][1]['message_id'], 5)
+        self.assertEqual(screen['kind'], 'photo')
+        self.assertIsNone(screen['message_id'])
+
+    def test_reply_keyboard_sends_and_deletes(self):
+        markup = ReplyKeyboardMarkup([[KeyboardButton('Адрес')]])
+        calls, _ = plan_screen(None, 1, 5, 'text', 'Адрес?', markup)
+        self.assertEqual(
+            self.get_methods(calls), ['send_message', 'delete_message']
+        )
+
+    def test_changed_text_is_edited(self):
+        _, last_screen = plan_screen(None, 1, 5, 'text', 'Корзина',
+                                     make_markup('a'))
+        calls, screen = plan_screen(last_screen, 1, 5, 'text', 'Пусто',
+                                    make_markup('a'))
+        self.assertEqual(self.get_methods(calls), ['edit_message_text'])
+        self.assertEqual(calls[0][1]['message_id'], 5)
+        self.assertEqual(screen['message_id'], 5)
+
+    def test_changed_photo_is_edited(self):
+        _, last_screen = plan_screen(None, 1, 5, 'photo', 'Пицца',
+                                     photo='F1')
+        calls, _ = plan_screen(last_screen, 1, 5, 'photo', 'Пицца',
+                               photo='F2')
+        self.assertEqual(self.get_methods(calls), ['edit_message_media'])
+
+    def test_photo_key_hides_file_id_change(self):
+        _, last_screen = plan_screen(None, 1, 5, 'photo', 'Пицца',
+                                     photo='http://img', photo_key='p1')
+        calls, _ = plan_screen(last_screen, 1, 5, 'photo', 'Пицца',
+                               photo='F', photo_key='p1')
+        self.assertEqual(calls, [])
+
+    def test_changed_markup_is_edited(self):
+        _, last_screen = plan_screen(None, 1, 5, 'text', 'Меню',
+                                     make_markup('a'))
+        calls, _ = plan_screen(last_screen, 1, 5, 'text', 'Меню',
+                               make_markup('b'))
+        self.assertEqual(
+            self.get_methods(calls), ['edit_message_reply_markup']
+        )
+
+    def test_same_screen_makes_no_calls(self):
+        _, last_screen = plan_screen(None, 1, 5, 'text', 'Меню',
+                                     make_markup('a'))
+        calls, _ = plan_screen(last_screen, 1, 5, 'text', 'Меню',
+                               make_markup('a'))
+        self.assertEqual(calls, [])
+
+    def test_unknown_last_id_is_the_tapped_message(self):
+        _, last_screen = plan_screen(None, 1, None, None, 'Меню',
+                                     make_markup('a'))
+        calls, screen = plan_screen(last_screen, 1, 7, 'text', 'Меню',
+                                    make_markup('a'))
+        self.assertEqual(calls, [])
+        self.assertEqual(screen['message_id'], 7)
+
+    def test_other_message_is_edited_in_full(self):
+        _, last_screen = plan_screen(None, 1, 5, 'text', 'Меню',
+                                     make_markup('a'))
+        calls, _ = plan_screen(last_screen, 1, 6, 'text', 'Меню',
+                               make_markup('a'))
+        self.assertEqual(self.get_methods(calls), ['edit_message_text'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,104 @@
+import unittest
+
+import fakeredis
+
+from sessions import SessionStore
+
+
+class SessionStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.db_connection = fakeredis.FakeRedis(decode_responses=True)
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+
+    def make_store(self):
+        store = SessionStore(self.db_connection, flush_interval=3600)
+        self.stores.append(store)
+        return store
+
+    def test_owner_write_is_deferred_until_flush(self):
+        store = self.make_store()
+        _, session = store.load(1)
+        session['product_id'] = 'p1'
+        store.save(1, 'HANDLE_DESCRIPTION', session)
+        self.assertIsNone(self.db_connection.get(1))
+
+        state, session = store.load(1)
+        self.assertEqual(state, 'HANDLE_DESCRIPTION')
+        self.assertEqual(session['product_id'], 'p1')
+
+        store.flush()
+        self.assertEqual(self.db_connection.get(1), 'HANDLE_DESCRIPTION')
+        self.assertEqual(
+            self.db_connection.hget(SessionStore.get_session_key(1),
+                                    'product_id'),
+            '"p1"'
+        )
+        self.assertEqual(
+            self.db_connection.get(SessionStore.get_version_key(1)), '1'
+        )
+
+    def test_non_owner_writes_directly_and_owner_rereads(self):
+        owner = self.make_store()
+        other = self.make_store()
+        owner.load(1)
+        self.assertEqual(
+            self.db_connection.get(SessionStore.get_owner_key(1)),
+            owner.owner_id
+        )
+
+        _, session = other.load(1)
+        session['product_id'] = 'p2'
+        other.save(1, 'HANDLE_MENU', session)
+        self.assertEqual(self.db_connection.get(1), 'HANDLE_MENU')
+
+        state, session = owner.load(1)
+        self.assertEqual(state, 'HANDLE_MENU')
+        self.assertEqual(session['product_id'], 'p2')
+
+    def test_flush_after_revoke_keeps_changes(self):
+        owner = self.make_store()
+        _, session = owner.load(1)
+        session['product_id'] = 'p1'
+        owner.save(1, 'HANDLE_DESCRIPTION', session)
+        self.db_connection.set(SessionStore.get_owner_key(1), 'other')
+
+        owner.flush()
+        self.assertIsNone(owner._local.get(1))
+        self.assertEqual(self.db_connection.get(1), 'HANDLE_DESCRIPTION')
+        self.assertEqual(
+            self.db_connection.hget(SessionStore.get_session_key(1),
+                                    'product_id'),
+            '"p1"'
+        )
+        self.assertEqual(
+            self.db_connection.get(SessionStore.get_owner_key(1)), 'other'
+        )
+
+    def test_owner_flush_over_newer_version_keeps_both(self):
+        owner = self.make_store()
+        other = self.make_store()
+        _, owner_session = owner.load(1)
+        _, other_session = other.load(1)
+        other_session['customer_coords'] = [55.75, 37.6]
+        other.save(1, 'LOCATION_WAITING', other_session)
+
+        owner_session['product_id'] = 'p1'
+        owner.save(1, None, owner_session)
+        owner.flush()
+
+        self.assertIsNone(owner._local.get(1))
+        state, session = owner.load(1)
+        self.assertEqual(state, 'LOCATION_WAITING')
+        self.assertEqual(session['product_id'], 'p1')
+        self.assertEqual(session['customer_coords'], [55.75, 37.6])
+        self.assertEqual(
+            self.db_connection.get(SessionStore.get_version_key(1)), '2'
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
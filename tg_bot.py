@@ -1,68 +1,205 @@
+import logging
+import math
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from functools import partial
 from textwrap import dedent
 
 import redis
 from dotenv import load_dotenv
-from geopy import distance
-from telegram import (
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-    ReplyKeyboardMarkup,
-    KeyboardButton
-)
-from telegram import LabeledPrice
-from telegram.ext import (
-    Updater, CommandHandler,
-    CallbackQueryHandler, MessageHandler,
-    Filters, PreCheckoutQueryHandler, JobQueue
-)
-
 
+from breakers import CircuitOpenError
+from caches import LRUCache, StaleWhileRevalidate
+from deadlines import UPDATE_BUDGET, Deadline
+from delivery_zones import DELIVERY_TIERS, DeliveryZones, get_tier
+from geocoding import GeocodingCache
+from invalidation import InvalidationSubscriber, start_events_server
+from jobs import JobScheduler
+from metrics import (
+    READY, STATE_HANDLER_SECONDS, Gauge, register, start_metrics_server,
+    timed, traced
+)
 from moltin_api import (
     add_product_to_cart, remove_product_from_cart,
-    get_all_products, get_cart_total, get_cart_products,
-    get_product_by_id, get_img_url, get_all_pizzerias,
-    create_customer_entry, get_deliveryman_id
+    iter_products, get_cart_products,
+    get_product_by_id, get_img_url, iter_pizzerias,
+    create_customer_entry, configure_client, get_access_token,
+    PAGE_PREFETCH
 )
-from yandex_api import fetch_coordinates
+from orders import Order, build_order, format_amount
+from outbox import PRIORITY_DEFERRED, PRIORITY_UI, PRIORITY_URGENT, Outbox
+from pizzerias import PizzeriaRegistry
+from screens import plan_screen
+from sessions import SessionStore
 
+CATALOG_TTL = 15 * 60
+MENU_PAGE_SIZE = 8
+PRODUCT_CARDS_MAXSIZE = 256
+PIZZERIAS_TTL = 10 * 60
+FOLLOW_UP_DELAY = 15
+CUSTOMER_ENTRY_DEDUPE_WINDOW = 60 * 60
+FOLLOW_UP_SEND_TIMEOUT = 30
+WARM_UP_RETRY_DELAY = 10
 
-def get_products_keyboard(update, congext):
-    products_descriptions = get_all_products(
-        congext.bot_data['client_id'],
-        congext.bot_data['client_secret']
+logger = logging.getLogger(__name__)
+
+
+def render_catalog(products):
+    """
+    Разбивает меню на страницы по MENU_PAGE_SIZE товаров, чтобы
+    клавиатура не вырастала больше, чем принимает Telegram.
+    """
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+    products = list(products)
+    pages_count = max(math.ceil(len(products) / MENU_PAGE_SIZE), 1)
+    pages = []
+    for page in range(pages_count):
+        keyboard = []
+        page_products = products[
+            page * MENU_PAGE_SIZE:(page + 1) * MENU_PAGE_SIZE
+        ]
+        for product in page_products:
+            keyboard.append([InlineKeyboardButton(
+                product['attributes']['name'],
+                callback_data=product['id'])])
+        navigation = []
+        if page > 0:
+            navigation.append(
+                InlineKeyboardButton('<', callback_data=f'menu:{page - 1}')
+            )
+        if page < pages_count - 1:
+            navigation.append(
+                InlineKeyboardButton('>', callback_data=f'menu:{page + 1}')
+            )
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append(
+            [InlineKeyboardButton('Корзина', callback_data='cart')]
+        )
+        pages.append(InlineKeyboardMarkup(keyboard))
+    return {
+        'products': products,
+        'pages': pages,
+    }
+
+
+def load_catalog(client_id, client_secret):
+    return render_catalog(iter_products(client_id, client_secret))
+
+
+def get_menu_page(callback_data):
+    """Номер страницы меню из callback_data вида menu:<номер>."""
+    if callback_data and callback_data.startswith('menu:'):
+        page = callback_data.removeprefix('menu:')
+        if page.isdecimal():
+            return int(page)
+    return None
+
+
+def get_products_keyboard(update, context, page=0):
+    pages = context.bot_data['catalog'].get()['pages']
+    return pages[min(page, len(pages) - 1)]
+
+
+def show_screen(update, context, text, reply_markup=None, photo=None,
+                photo_key=None, callback=None):
+    query = update.callback_query
+    message = query and query.message
+    session = context.chat_data['session']
+    calls, screen = plan_screen(
+        session.get('screen'),
+        update.effective_chat.id,
+        message and message.message_id,
+        message and ('photo' if message.photo else 'text'),
+        text,
+        reply_markup,
+        photo,
+        photo_key
     )
-    congext.bot_data['products_descriptions'] = products_descriptions
-    keyboard = []
-    for product in products_descriptions['data']:
-        keyboard.append([InlineKeyboardButton(
-            product['attributes']['name'],
-            callback_data=product['id'])])
-    keyboard.append([InlineKeyboardButton('Корзина', callback_data='cart')])
-    return InlineKeyboardMarkup(keyboard)
+    session['screen'] = screen
+    if not calls and query:
+        query.answer()
+    outbox = context.bot_data['outbox']
+    for method, kwargs in calls:
+        outbox.send(
+            PRIORITY_UI,
+            method,
+            callback=callback if method != 'delete_message' else None,
+            **kwargs
+        )
 
 
 def start(update, context):
     reply_markup = get_products_keyboard(update, context)
-    if update.message:
-        update.message.reply_text(
-            'Выберите продукт:', reply_markup=reply_markup
-        )
-    else:
-        query = update.callback_query
-        query.message.reply_text(
-            'Выберите продукт',
-            reply_markup=reply_markup
-        )
-        chat_id = update.effective_chat.id
-        context.bot.delete_message(
-            chat_id=chat_id,
-            message_id=query.message.message_id
-        )
+    show_screen(update, context, 'Выберите продукт:', reply_markup)
     return 'HANDLE_MENU'
 
 
-def handle_menu(update, context):
+def render_product_card(product, image_url):
+    return {
+        'name': product['attributes']['name'],
+        'description': product['attributes']['description'],
+        'price': product['meta']['display_price']['without_tax']['formatted'],
+        'image_url': image_url,
+        'image_id': product['relationships']['main_image']['data']['id'],
+        'file_id': None,
+        'loaded_at': time.monotonic(),
+    }
+
+
+def is_card_stale(card, ttl):
+    """
+    Карточка устарела, если её пометил сброс кэшей или она старше ttl:
+    без слушателя событий Moltin цены иначе не обновлялись бы вовсе.
+    """
+    return card.get('stale') or time.monotonic() - card['loaded_at'] > ttl
+
+
+def load_product_card(client_id, client_secret, product_id):
+    product = get_product_by_id(client_id, client_secret, product_id)['data']
+    img_id = product['relationships']['main_image']['data']['id']
+    image_url = get_img_url(client_id, client_secret, img_id)
+    return render_product_card(product, image_url)
+
+
+def get_product_card(context, product_id):
+    product_cards = context.bot_data['product_cards']
+    card = product_cards.get(product_id)
+    if card is None or is_card_stale(card, context.bot_data['catalog'].ttl):
+        try:
+            fresh_card = load_product_card(
+                context.bot_data['client_id'],
+                context.bot_data['client_secret'],
+                product_id
+            )
+        except Exception:
+            if card is None:
+                raise
+            logger.warning('Показываю старую карточку товара %s', product_id)
+            return card
+        card = fresh_card
+        product_cards.set(product_id, card)
+    return card
+
+
+def get_product_text(card):
+    return dedent(
+        f'''
+            {card['name']}
+            Стоимость: {card['price']}
+
+            {card['description']}
+        '''
+    )
+
+
+def get_description_markup():
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
     keyboard = [
         [
             InlineKeyboardButton(
@@ -72,53 +209,39 @@ def handle_menu(update, context):
             InlineKeyboardButton('Назад', callback_data='back')
         ]
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
-    query = update.callback_query
-    product_id = query['data']
-    context.bot_data['product_id'] = product_id
-    client_id = context.bot_data.get('client_id')
-    client_secret = context.bot_data.get('client_secret')
+    return InlineKeyboardMarkup(keyboard)
 
-    selected_product = get_product_by_id(
-        client_id,
-        client_secret,
-        product_id
-    )['data']
-
-    product_price = \
-        selected_product['meta']['display_price']['without_tax']['formatted']
-    img_id = \
-        selected_product['relationships']['main_image']['data']['id']
-    product_image_url = get_img_url(client_id, client_secret, img_id)
-    chat_id = update.effective_chat.id
 
-    text = dedent(
-        f'''
-            {selected_product['attributes']['name']}
-            Стоимость: {product_price}
+def remember_file_id(card, message):
+    card['file_id'] = message.photo[-1].file_id
 
-            {selected_product['attributes']['description']}
-        '''
-    )
-    if product_image_url:
-        context.bot.send_photo(
-            photo=product_image_url,
-            chat_id=chat_id,
-            caption=text,
-            reply_markup=reply_markup
-        )
-    else:
-        context.bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            reply_markup=reply_markup
-        )
 
-    context.bot.delete_message(
-        chat_id=chat_id,
-        message_id=query.message.message_id, )
+def handle_menu(update, context):
+    reply_markup = get_description_markup()
 
+    query = update.callback_query
+    menu_page = get_menu_page(query['data'])
+    if menu_page is not None:
+        show_screen(
+            update,
+            context,
+            'Выберите продукт:',
+            get_products_keyboard(update, context, menu_page)
+        )
+        return 'HANDLE_MENU'
+    product_id = query['data']
+    context.chat_data['session']['product_id'] = product_id
+    card = get_product_card(context, product_id)
+
+    show_screen(
+        update,
+        context,
+        get_product_text(card),
+        reply_markup,
+        photo=card['file_id'] or card['image_url'],
+        photo_key=card['image_url'],
+        callback=partial(remember_file_id, card)
+    )
     return 'HANDLE_DESCRIPTION'
 
 
@@ -134,26 +257,30 @@ def handle_description(update, context):
         client_id=context.bot_data['client_id'],
         client_secret=context.bot_data['client_secret'],
         cart_id=cart_id,
-        product_id=context.bot_data['product_id'],
+        product_id=context.chat_data['session']['product_id'],
         quantity=1
     )
     query.answer()
     return 'HANDLE_DESCRIPTION'
 
 
-def get_cart_contents(client_id, client_secret, cart_id):
-    cart_products = get_cart_products(client_id, client_secret, cart_id)
+def get_order_text(order):
     cart_display = []
-    for product in cart_products['data']:
-        total_price = \
-            product['meta']['display_price']['with_tax']['value']['formatted'][1:]
+    for item in order.items:
+        total_price = format_amount(item.amount)
         cart_display.append(dedent(
             f'''\
-                {product['name']}
-                {product['description'].strip()}
-                {product['quantity']} пицц в корзине на сумму {total_price} ₽
+                {item.name}
+                {item.description}
+                {item.quantity} пицц в корзине на сумму {total_price} ₽
             '''
         ))
+    cart_display.append(f'К оплате: {format_amount(order.total_amount)} ₽')
+    return '\n\n'.join(cart_display)
+
+
+def render_cart(cart_products):
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
     keyboard = [
         [
@@ -165,45 +292,32 @@ def get_cart_contents(client_id, client_secret, cart_id):
         for product in cart_products['data']
     ]
     keyboard.append([InlineKeyboardButton('В меню', callback_data='/start')])
-    if cart_products:
+    if cart_products['data']:
         keyboard.append(
             [InlineKeyboardButton('Заказать', callback_data='payment')]
         )
-        cart_display.append(
-            f'К оплате: {get_cart_total(client_id, client_secret, cart_id)[1:]} ₽'
-        )
-    text = '\n\n'.join(cart_display) if cart_products else 'Корзина пуста'
+    text = get_order_text(build_order(cart_products)) \
+        if cart_products['data'] else 'Корзина пуста'
     markup = InlineKeyboardMarkup(keyboard)
 
     return text, markup
 
 
-def send_order_to_deliveryman(update, context, client_id,
-                              client_secret, cart_id, deliveryman_id):
-    message_text, _ = get_cart_contents(client_id, client_secret, cart_id)
-    context.bot.send_message(
-        chat_id=deliveryman_id,
-        text=message_text,
-    )
-    context.bot.delete_message(
-        chat_id=cart_id,
-        message_id=update.callback_query.message.message_id
+def send_order_to_deliveryman(context, order):
+    context.bot_data['outbox'].send(
+        PRIORITY_URGENT,
+        'send_message',
+        chat_id=order.courier_id,
+        text=get_order_text(order),
     )
 
 
-def send_cart_contents(update, context, client_id, client_secret, cart_id):
-    message_text, reply_markup = get_cart_contents(
-        client_id, client_secret, cart_id
-    )
-    context.bot.send_message(
-        chat_id=cart_id,
-        text=message_text,
-        reply_markup=reply_markup
-    )
-    context.bot.delete_message(
-        chat_id=cart_id,
-        message_id=update.callback_query.message.message_id
-    )
+def send_cart_contents(update, context, client_id, client_secret, cart_id,
+                       cart_products=None):
+    if cart_products is None:
+        cart_products = get_cart_products(client_id, client_secret, cart_id)
+    message_text, reply_markup = render_cart(cart_products)
+    show_screen(update, context, message_text, reply_markup)
 
 
 def handle_cart(update, context):
@@ -214,60 +328,65 @@ def handle_cart(update, context):
     if query['data'] == 'cart':
         send_cart_contents(update, context, client_id, client_secret, cart_id)
     elif query['data'] == 'payment':
+        cart_products = get_cart_products(client_id, client_secret, cart_id)
+        context.chat_data['session']['order'] = \
+            build_order(cart_products).to_dict()
         handle_location_waiting(update, context)
         return 'LOCATION_WAITING'
     else:
-        remove_product_from_cart(
+        cart_products = remove_product_from_cart(
             client_id,
             client_secret,
             cart_id,
             query['data']
         )
-        send_cart_contents(update, context, client_id, client_secret, cart_id)
+        send_cart_contents(update, context, client_id, client_secret,
+                           cart_id, cart_products)
     return 'HANDLE_CART'
 
 
-def handle_location_waiting(update, context):
-    query = update.callback_query
+def get_location_markup():
+    from telegram import KeyboardButton, ReplyKeyboardMarkup
 
     message_keyboard = [[
         KeyboardButton('Отправить геопозицию', request_location=True)
     ]]
-    markup = ReplyKeyboardMarkup(message_keyboard,
-                                 one_time_keyboard=True,
-                                 resize_keyboard=True)
+    return ReplyKeyboardMarkup(message_keyboard,
+                               one_time_keyboard=True,
+                               resize_keyboard=True)
+
+
+def get_unknown_address_text():
+    return dedent(
+        '''
+            Не могу распознать адрес.
+            Пожалуйста, проверьте правильность ввода
+        '''
+    )
+
+
+def handle_location_waiting(update, context):
+    markup = get_location_markup()
+    chat_id = update.effective_chat.id
     if update.message and update.message.location:
         handle_location(update, context)
         return send_delivery_terms(update, context)
     if update.message:
-        yandex_api_key = context.bot_data['yandex_api_key']
-        coords = fetch_coordinates(yandex_api_key, update.message.text)
+        geocoder = context.bot_data['geocoder']
+        coords = geocoder.fetch_coordinates(update.message.text)
         if not coords:
-            update.message.reply_text(
-                text=dedent(
-                    '''
-                        Не могу распознать адрес.
-                        Пожалуйста, проверьте правильность ввода
-                    '''
-                ),
-                reply_markup=markup
-            )
+            show_screen(update, context, get_unknown_address_text(), markup)
             return 'LOCATION_WAITING'
         lat, lon = coords
-        client_id = context.bot_data['client_id']
-        client_secret = context.bot_data['client_secret']
-        chat_id = update.effective_chat.id
-        context.bot_data['customer_coords'] = coords
-        create_customer_entry(client_id, client_secret, chat_id, lat, lon)
+        context.chat_data['session']['customer_coords'] = coords
+        schedule_customer_entry(context, chat_id, lat, lon)
         return send_delivery_terms(update, context)
     else:
-        query.message.reply_text(
-            text='Хорошо, пришлите нам Ваш адрес текстом или геолокацию.',
-            reply_markup=markup
-        )
-        context.bot.delete_message(
-            chat_id=update.effective_chat.id,
-            message_id=update.callback_query.message.message_id
+        show_screen(
+            update,
+            context,
+            'Хорошо, пришлите нам Ваш адрес текстом или геолокацию.',
+            markup
         )
         return 'LOCATION_WAITING'
 
@@ -275,39 +394,53 @@ def handle_location_waiting(update, context):
 def handle_location(update, context):
     lat = update.message.location['latitude']
     lon = update.message.location['longitude']
-    client_id = context.bot_data['client_id']
-    client_secret = context.bot_data['client_secret']
     chat_id = update.effective_chat.id
 
-    context.bot_data['customer_coords'] = lat, lon
-    create_customer_entry(client_id, client_secret, chat_id, lat, lon)
+    context.chat_data['session']['customer_coords'] = lat, lon
+    schedule_customer_entry(context, chat_id, lat, lon)
 
 
-def get_distances(distances_to_customer):
-    return distances_to_customer['distance']
+def schedule_customer_entry(context, chat_id, lat, lon):
+    lat, lon = float(lat), float(lon)
+    context.bot_data['jobs'].schedule(
+        'create_customer_entry',
+        {'chat_id': chat_id, 'lat': lat, 'lon': lon},
+        0,
+        idempotency_key=f'customer-entry:{chat_id}:{lat:.4f}:{lon:.4f}',
+        dedupe_ttl=CUSTOMER_ENTRY_DEDUPE_WINDOW
+    )
+
+
+def write_customer_entry(client_id, client_secret, payload):
+    create_customer_entry(
+        client_id,
+        client_secret,
+        payload['chat_id'],
+        payload['lat'],
+        payload['lon']
+    )
+
+
+def load_pizzerias(client_id, client_secret, pizzeria_registry):
+    pizzeria_registry.update(iter_pizzerias(client_id, client_secret))
+    return pizzeria_registry
 
 
 def min_distance_calculation(update, context):
-    client_id = context.bot_data['client_id']
-    client_secret = context.bot_data['client_secret']
-    customer_coords = context.bot_data['customer_coords']
-    all_pizzerias_data = get_all_pizzerias(client_id, client_secret)
-
-    pizzerias_with_distance_to_customer = []
-    for pizzeria in all_pizzerias_data:
-        pizzeria_coords = pizzeria['lat'], pizzeria['lon']
-        pizzerias_with_distance_to_customer.append(
-            {
-                'address': pizzeria['address'],
-                'distance':
-                    distance.distance(pizzeria_coords, customer_coords).km,
-            }
-        )
-    return min(pizzerias_with_distance_to_customer, key=get_distances)
+    customer_coords = context.chat_data['session']['customer_coords']
+    pizzeria_registry = context.bot_data['pizzerias'].get()
+    distance_to_customer, pizzeria = \
+        pizzeria_registry.find_nearest(customer_coords)
+    return {
+        'id': pizzeria['id'],
+        'address': pizzeria['address'],
+        'distance': distance_to_customer,
+    }
 
 
-def send_delivery_terms(update, context):
-    nearest_pizzeria = min_distance_calculation(update, context)
+def get_delivery_terms(nearest_pizzeria):
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
     distance_to_customer = nearest_pizzeria['distance']
 
     keyboard = [
@@ -315,7 +448,8 @@ def send_delivery_terms(update, context):
         [InlineKeyboardButton('Самовывоз', callback_data='pickup')]
     ]
 
-    if distance_to_customer <= .5:
+    tier = get_tier(distance_to_customer)
+    if tier == 0:
         text = dedent(
             f'''
                 Может, заберте пиццу из нашей пиццерии неподалёку?
@@ -324,21 +458,23 @@ def send_delivery_terms(update, context):
                 А можем и бесплатно доставить, нам не сложно
             '''
         )
-    elif distance_to_customer <= 5:
+    elif tier == 1:
+        _, delivery_price = DELIVERY_TIERS[tier]
         text = dedent(
             f'''
                 Похоже, придётся ехать до вас на самокате.
-                Доставка будет стоить 100 рублей.
+                Доставка будет стоить {delivery_price} рублей.
                 Доставляем или самовывоз?
 
                 Адрес для самовывоза:
                 {nearest_pizzeria['address']}
             '''
         )
-    elif distance_to_customer <= 20:
+    elif tier == 2:
+        _, delivery_price = DELIVERY_TIERS[tier]
         text = dedent(
             f'''
-                Доставка будет стоить 300 рублей. Доставляем или самовывоз?
+                Доставка будет стоить {delivery_price} рублей. Доставляем или самовывоз?
 
                 Адрес для самовывоза:
                 {nearest_pizzeria['address']}
@@ -354,89 +490,152 @@ def send_delivery_terms(update, context):
         )
         del keyboard[0]
 
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    context.bot.send_message(
-        text=text,
-        chat_id=update.message.chat_id,
-        reply_markup=reply_markup
+    return text, InlineKeyboardMarkup(keyboard)
+
+
+def get_session_order(context, chat_id):
+    """
+    Снимок заказа из сессии. У чатов, начавших оформление до появления
+    снимков, его нет: тогда он собирается из корзины заново.
+    """
+    session = context.chat_data['session']
+    if 'order' not in session:
+        cart_products = get_cart_products(
+            context.bot_data['client_id'],
+            context.bot_data['client_secret'],
+            chat_id
+        )
+        session['order'] = build_order(cart_products).to_dict()
+    return Order.from_dict(session['order'])
+
+
+def send_delivery_terms(update, context):
+    nearest_pizzeria = min_distance_calculation(update, context)
+    text, reply_markup = get_delivery_terms(nearest_pizzeria)
+    show_screen(update, context, text, reply_markup)
+    session = context.chat_data['session']
+    order = replace(
+        get_session_order(context, update.effective_chat.id),
+        customer_coords=tuple(session['customer_coords']),
+        pizzeria_id=nearest_pizzeria['id'],
+        pizzeria_address=nearest_pizzeria['address'],
+        distance=nearest_pizzeria['distance'],
     )
-    context.bot_data['nearest_pizzeria'] = nearest_pizzeria
+    session['order'] = order.to_dict()
     return 'HANDLE_SHIPPING_METHOD'
 
 
+def get_pickup_text(address):
+    return dedent(
+        f'''
+            Адрес для самовывоза:
+            {address}
+        '''
+    )
+
+
+def get_no_courier_screen():
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+    text = dedent(
+        '''
+            Сейчас эта пиццерия не может доставить заказ.
+            Вы можете забрать его сами.
+        '''
+    )
+    keyboard = [[InlineKeyboardButton('Самовывоз', callback_data='pickup')]]
+    return text, InlineKeyboardMarkup(keyboard)
+
+
 def handle_shipping_method(update, context):
     query = update.callback_query
     chat_id = update.effective_chat.id
-    client_id = context.bot_data['client_id']
-    client_secret = context.bot_data['client_secret']
+    session = context.chat_data['session']
+    if session.get('order', {}).get('pizzeria_id') is None:
+        # Оформление началось до появления снимков заказа: пиццерию
+        # выбираем заново.
+        if 'customer_coords' in session:
+            return send_delivery_terms(update, context)
+        return handle_location_waiting(update, context)
+    order = Order.from_dict(session['order'])
+    outbox = context.bot_data['outbox']
     if query['data'] == 'pickup':
-        query.message.reply_text(
-            text=dedent(
-                f'''
-                    Адрес для самовывоза:
-                    {context.bot_data['nearest_pizzeria']['address']}
-                '''
-            )
+        outbox.send(
+            PRIORITY_UI,
+            'send_message',
+            chat_id=chat_id,
+            text=get_pickup_text(order.pizzeria_address)
         )
         return
-    query.message.reply_text(
-        text='После оплаты заказ будет передан курьеру'
-    )
 
-    deliveryman_id = get_deliveryman_id(
-        client_id,
-        client_secret,
-        context.bot_data['nearest_pizzeria']['address']
+    pizzeria_registry = context.bot_data['pizzerias'].get()
+    courier_id = pizzeria_registry.get_courier_id(order.pizzeria_id)
+    if courier_id is None:
+        logger.error('У пиццерии %s нет курьера', order.pizzeria_id)
+        show_screen(update, context, *get_no_courier_screen())
+        return 'HANDLE_SHIPPING_METHOD'
+    show_screen(update, context, 'После оплаты заказ будет передан курьеру')
+    order = replace(order, courier_id=courier_id)
+    session['order'] = order.to_dict()
+    send_order_to_deliveryman(context, order)
+
+    context.bot_data['jobs'].schedule(
+        'write_to_customer',
+        {'chat_id': chat_id},
+        FOLLOW_UP_DELAY,
+        idempotency_key=f'follow-up:{chat_id}:{query.message.message_id}'
     )
-    send_order_to_deliveryman(update, context,
-                              client_id, client_secret,
-                              chat_id, deliveryman_id)
-
-    context.job_queue.run_once(
-        write_to_customer,
-        15,
-        context=chat_id
-    )
-    return start_without_shipping_callback(update, context, chat_id)
+    return start_without_shipping_callback(context, chat_id, order)
 
 
-def write_to_customer(context):
-    text = dedent(
+def get_follow_up_text():
+    return dedent(
             '''
                 Приятного аппетита! *место для рекламы*
                 *сообщение что делать если пицца не пришла*
             '''
         )
-    context.bot.send_message(
-        context.job.context,
-        text=text,
-    )
 
 
-def start_without_shipping_callback(update, context, chat_id):
-    client_id = context.bot_data['client_id']
-    client_secret = context.bot_data['client_secret']
+def write_to_customer(outbox, payload):
+    """
+    Ждёт, пока сообщение действительно уйдёт: если отправка не удалась,
+    исключение вернёт задачу в очередь для повтора.
+    """
+    outbox.send(
+        PRIORITY_DEFERRED,
+        'send_message',
+        chat_id=payload['chat_id'],
+        text=get_follow_up_text(),
+    ).result(FOLLOW_UP_SEND_TIMEOUT)
+
+
+def get_invoice_prices(order):
+    from telegram import LabeledPrice
+
+    return [LabeledPrice('Test', order.total_amount)]
+
+
+def start_without_shipping_callback(context, chat_id, order):
     payment_token = context.bot_data['payment_token']
 
     title = 'Заказ'
     description = 'Описание платежа'
     payload = 'Custom-Payload'
     provider_token = payment_token
-    currency = 'RUB'
-    cart_total_price = get_cart_total(
-        client_id, client_secret, cart_id=chat_id
-    )
-    price = float(cart_total_price[1:]) * 100
-    prices = [LabeledPrice('Test', int(price))]
-
-    context.bot.send_invoice(
-        chat_id,
-        title,
-        description,
-        payload,
-        provider_token,
-        currency,
-        prices,
+    currency = order.currency
+    prices = get_invoice_prices(order)
+
+    context.bot_data['outbox'].send(
+        PRIORITY_URGENT,
+        'send_invoice',
+        chat_id=chat_id,
+        title=title,
+        description=description,
+        payload=payload,
+        provider_token=provider_token,
+        currency=currency,
+        prices=prices,
     )
 
 
@@ -446,7 +645,9 @@ def precheckout_callback(update, context):
         query.answer(ok=False, error_message="Something went wrong...")
     else:
         query.answer(ok=True)
-        context.bot.send_message(
+        context.bot_data['outbox'].send(
+            PRIORITY_URGENT,
+            'send_message',
             text='Заказ передан курьеру, ожидайте',
             chat_id=query.from_user.id
         )
@@ -469,8 +670,18 @@ def handle_users_reply(update, context):
     поэтому по этой фразе выставляется стартовое состояние.
     Если пользователь захочет начать общение с ботом заново, он также
     может воспользоваться этой командой.
+    На весь апдейт отводится update_budget секунд: запросы к Moltin,
+    геокодеру и Redis берут таймауты из оставшегося времени.
     """
-    db_connection = context.bot_data['db_connection']
+    update_deadline = Deadline(
+        context.bot_data.get('update_budget', UPDATE_BUDGET)
+    )
+    with traced('update'):
+        process_users_reply(update, context, update_deadline)
+
+
+def process_users_reply(update, context, update_deadline):
+    session_store = context.bot_data['sessions']
     if update.message:
         user_reply = update.message.text
         chat_id = update.message.chat_id
@@ -479,12 +690,17 @@ def handle_users_reply(update, context):
         chat_id = update.effective_chat.id
     else:
         return
+    with update_deadline.active():
+        stored_state, session = session_store.load(chat_id)
+    context.chat_data['session'] = session
     if user_reply == '/start':
         user_state = 'START'
     elif user_reply == 'cart':
         user_state = 'HANDLE_CART'
+    elif update.callback_query and get_menu_page(user_reply) is not None:
+        user_state = 'HANDLE_MENU'
     else:
-        user_state = db_connection.get(chat_id)
+        user_state = stored_state or 'START'
     states_functions = {
         'START': start,
         'HANDLE_MENU': handle_menu,
@@ -496,36 +712,130 @@ def handle_users_reply(update, context):
     }
 
     state_handler = states_functions[user_state]
-    next_state = state_handler(update, context)
-    if next_state:
-        db_connection[chat_id] = next_state
+    try:
+        with update_deadline.active(), \
+                timed(STATE_HANDLER_SECONDS, state=user_state):
+            next_state = state_handler(update, context)
+    except Exception as error:
+        if not isinstance(error, CircuitOpenError) \
+                and not update_deadline.is_expired():
+            raise
+        logger.warning('%s, апдейт чата %s не обработан', error, chat_id)
+        context.bot_data['outbox'].send(
+            PRIORITY_UI,
+            'send_message',
+            chat_id=chat_id,
+            text=get_unavailable_text()
+        )
+        return
+    session_store.save(chat_id, next_state, session)
 
 
-def main():
-    load_dotenv()
-    updater = Updater(os.getenv('TG_TOKEN'))
-    dispatcher = updater.dispatcher
+def get_unavailable_text():
+    return dedent(
+        '''
+            Сервис временно недоступен.
+            Пожалуйста, повторите через минуту.
+        '''
+    )
+
+
+def get_geocoding_stats(geocoder):
+    return [
+        ((('result', result),), count)
+        for result, count in geocoder.stats.items()
+    ]
+
+
+def connect_redis():
+    from instrumented_clients import DeadlineConnection, InstrumentedRedis
+
+    connection_pool = redis.ConnectionPool(
+        connection_class=DeadlineConnection,
+        host=os.getenv('REDIS_HOST'),
+        port=os.getenv('REDIS_PORT'),
+        db=0,
+        password=os.getenv('REDIS_PASSWORD'),
+        socket_timeout=float(os.getenv('REDIS_TIMEOUT', 5)),
+        decode_responses=True
+    )
+    return InstrumentedRedis(connection_pool=connection_pool)
+
+
+def setup_dispatcher(dispatcher, workers):
+    from telegram.ext import (
+        CommandHandler, CallbackQueryHandler, MessageHandler,
+        Filters, PreCheckoutQueryHandler
+    )
 
     client_id = os.getenv('CLIENT_ID')
     client_secret = os.getenv('CLIENT_SECRET')
     yandex_api_key = os.getenv('YANDEX_GEOCODER_API_KEY')
     payment_token = os.getenv('PAYMENT_TOKEN')
-    redis_host = os.getenv('REDIS_HOST')
-    redis_port = os.getenv('REDIS_PORT')
-    redis_password = os.getenv('REDIS_PASSWORD')
-    redis_connection = redis.Redis(
-        host=redis_host,
-        port=redis_port,
-        db=0,
-        password=redis_password,
-        decode_responses=True
+    hedge_after = os.getenv('MOLTIN_HEDGE_AFTER')
+    jobs_workers = int(os.getenv('JOBS_WORKERS', 4))
+    redis_connection = connect_redis()
+    # Сессию Moltin делят обработчики апдейтов, фоновые задачи и
+    # параллельная загрузка страниц каталога.
+    configure_client(
+        client_id,
+        client_secret,
+        pool_size=workers + jobs_workers + PAGE_PREFETCH,
+        db_connection=redis_connection,
+        hedge_after=float(hedge_after) if hedge_after else None
     )
 
     dispatcher.bot_data['db_connection'] = redis_connection
+    dispatcher.bot_data['outbox'] = Outbox(
+        dispatcher.bot,
+        workers=int(os.getenv('OUTBOX_WORKERS', 4))
+    )
+    dispatcher.bot_data['sessions'] = SessionStore(redis_connection)
+    dispatcher.bot_data['jobs'] = JobScheduler(redis_connection, {
+        'write_to_customer': partial(
+            write_to_customer,
+            dispatcher.bot_data['outbox']
+        ),
+        'create_customer_entry': partial(
+            write_customer_entry,
+            client_id,
+            client_secret
+        ),
+    }, workers=jobs_workers)
     dispatcher.bot_data['client_id'] = client_id
     dispatcher.bot_data['client_secret'] = client_secret
     dispatcher.bot_data['yandex_api_key'] = yandex_api_key
     dispatcher.bot_data['payment_token'] = payment_token
+    dispatcher.bot_data['update_budget'] = float(
+        os.getenv('UPDATE_BUDGET', UPDATE_BUDGET)
+    )
+    dispatcher.bot_data['catalog'] = StaleWhileRevalidate(
+        partial(load_catalog, client_id, client_secret),
+        int(os.getenv('CATALOG_TTL', CATALOG_TTL))
+    )
+    dispatcher.bot_data['geocoder'] = GeocodingCache(
+        redis_connection,
+        yandex_api_key
+    )
+    register(Gauge(
+        'tg_pizza_geocoding_cache_total',
+        'Обращения к кэшу геокодера',
+        partial(get_geocoding_stats, dispatcher.bot_data['geocoder'])
+    ))
+    dispatcher.bot_data['product_cards'] = LRUCache(PRODUCT_CARDS_MAXSIZE)
+    dispatcher.bot_data['pizzerias'] = StaleWhileRevalidate(
+        partial(
+            load_pizzerias,
+            client_id,
+            client_secret,
+            PizzeriaRegistry(DeliveryZones(os.getenv('DELIVERY_ZONES_PATH')))
+        ),
+        int(os.getenv('PIZZERIAS_TTL', PIZZERIAS_TTL))
+    )
+    dispatcher.bot_data['invalidation'] = InvalidationSubscriber(
+        redis_connection,
+        dispatcher.bot_data
+    )
 
     dispatcher.add_handler(CallbackQueryHandler(handle_users_reply))
     dispatcher.add_handler(
@@ -537,9 +847,103 @@ def main():
     dispatcher.add_handler(CommandHandler('start', handle_users_reply))
     dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
 
+
+def warm_up(bot_data, workers):
+    """
+    Параллельно получает токен Moltin, каталог, карточки товаров со
+    ссылками на картинки и пиццерии, чтобы первые клиенты после
+    запуска не ждали холодных кэшей. Ошибка токена, каталога или
+    пиццерий пробрасывается. Карточки, которые не загрузились,
+    пропускаются: их загрузят при первом показе. Уже загруженные
+    карточки при повторном прогреве не запрашиваются.
+    """
+    client_id = bot_data['client_id']
+    client_secret = bot_data['client_secret']
+    product_cards = bot_data['product_cards']
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        token = executor.submit(get_access_token, client_id, client_secret)
+        pizzerias = executor.submit(bot_data['pizzerias'].get)
+        catalog = bot_data['catalog'].get()
+        card_futures = {
+            product['id']: executor.submit(
+                load_product_card, client_id, client_secret, product['id']
+            )
+            for product in catalog['products'][:PRODUCT_CARDS_MAXSIZE]
+            if product_cards.get(product['id']) is None
+        }
+    failed_ids = []
+    for product_id, card in card_futures.items():
+        if card.exception():
+            failed_ids.append(product_id)
+        else:
+            product_cards.set(product_id, card.result())
+    if failed_ids:
+        logger.warning('Не загружены карточки %s товаров, первый: %s',
+                       len(failed_ids), failed_ids[0])
+    token.result()
+    pizzerias.result()
+
+
+def prepare(bot_data, workers, retry_delay=WARM_UP_RETRY_DELAY):
+    """
+    Готовность выставляется, когда получены токен, каталог и пиццерии.
+    Если их получить не удалось, бот работает с холодными кэшами, а
+    прогрев повторяется в фоне раз в retry_delay секунд.
+    """
+    try:
+        warm_up(bot_data, workers)
+    except Exception:
+        logger.exception('Не удалось прогреть кэши, повтор через %s с',
+                         retry_delay)
+        retry = threading.Timer(
+            retry_delay,
+            prepare,
+            args=(bot_data, workers, retry_delay)
+        )
+        retry.daemon = True
+        retry.start()
+        return
+    READY.set()
+
+
+def main():
+    from telegram import Bot
+    from telegram.ext import Updater
+
+    from instrumented_clients import InstrumentedRequest
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    workers = int(os.getenv('BOT_WORKERS', 4))
+    bot = Bot(
+        os.getenv('TG_TOKEN'),
+        request=InstrumentedRequest(
+            con_pool_size=workers + int(os.getenv('OUTBOX_WORKERS', 4)) + 4
+        )
+    )
+    updater = Updater(bot=bot, workers=workers)
+    dispatcher = updater.dispatcher
+    setup_dispatcher(dispatcher, workers)
+    if os.getenv('METRICS_PORT'):
+        start_metrics_server(
+            int(os.getenv('METRICS_PORT')),
+            float(os.getenv('TRACE_SAMPLE_RATE', 0))
+        )
+    if os.getenv('MOLTIN_EVENTS_PORT'):
+        start_events_server(
+            int(os.getenv('MOLTIN_EVENTS_PORT')),
+            dispatcher.bot_data['db_connection'],
+            os.getenv('MOLTIN_EVENTS_SECRET')
+        )
+    prepare(dispatcher.bot_data, workers)
+
     updater.start_polling()
 
     updater.idle()
+    dispatcher.bot_data['invalidation'].close()
+    dispatcher.bot_data['jobs'].close()
+    dispatcher.bot_data['outbox'].close()
+    dispatcher.bot_data['sessions'].close()
 
 
 if __name__ == '__main__':
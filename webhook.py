@@ -0,0 +1,213 @@
+import hmac
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from dotenv import load_dotenv
+from telegram import Bot, Update
+from telegram.ext import Dispatcher
+
+from instrumented_clients import InstrumentedRequest
+from invalidation import start_events_server
+from metrics import READY, start_metrics_server
+from tg_bot import connect_redis, prepare, setup_dispatcher
+
+logger = logging.getLogger(__name__)
+
+
+def get_chat_id(raw_update):
+    for update_type in ('message', 'edited_message', 'channel_post'):
+        if update_type in raw_update:
+            return raw_update[update_type]['chat']['id']
+    callback_query = raw_update.get('callback_query')
+    if callback_query and 'message' in callback_query:
+        return callback_query['message']['chat']['id']
+    for value in raw_update.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return raw_update.get('update_id', 0)
+
+
+def get_shard(chat_id, shards_count):
+    return zlib.crc32(str(chat_id).encode()) % shards_count
+
+
+def process_lane(dispatcher, lane_queue):
+    while True:
+        update = lane_queue.get()
+        dispatcher.process_update(update)
+
+
+def signal_when_ready(ready_event):
+    READY.wait()
+    ready_event.set()
+
+
+def run_worker(worker_index, update_queue, lanes_count, queue_size,
+               ready_event):
+    """
+    Процесс-воркер: разбирает апдейты из своей очереди и раскладывает
+    их по потокам-полосам по chat_id, так что апдейты одного чата
+    обрабатываются по порядку, а разные чаты — параллельно.
+    Поднимает ready_event, когда прогрев кэшей удался; если первая
+    попытка не удалась, апдейты уже принимаются, но вебхук ждёт.
+    """
+    load_dotenv()
+    bot = Bot(
+        os.getenv('TG_TOKEN'),
+        request=InstrumentedRequest(
+            con_pool_size=lanes_count + int(os.getenv('OUTBOX_WORKERS', 4)) + 4
+        )
+    )
+    if os.getenv('METRICS_PORT'):
+        start_metrics_server(
+            int(os.getenv('METRICS_PORT')) + 1 + worker_index,
+            float(os.getenv('TRACE_SAMPLE_RATE', 0))
+        )
+    dispatcher = Dispatcher(bot, None, workers=1)
+    setup_dispatcher(dispatcher, lanes_count)
+    prepare(dispatcher.bot_data, lanes_count)
+    threading.Thread(
+        target=signal_when_ready,
+        args=(ready_event,),
+        daemon=True
+    ).start()
+
+    lane_queues = [
+        queue.Queue(maxsize=queue_size) for _ in range(lanes_count)
+    ]
+    for lane_queue in lane_queues:
+        threading.Thread(
+            target=process_lane,
+            args=(dispatcher, lane_queue),
+            daemon=True
+        ).start()
+
+    while True:
+        raw_update = json.loads(update_queue.get())
+        lane = get_shard(get_chat_id(raw_update), lanes_count)
+        lane_queues[lane].put(Update.de_json(raw_update, bot))
+
+
+def make_request_handler(webhook_path, worker_queues, put_timeout,
+                         ready_events, secret_token=None):
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/ready':
+                self.send_response(404)
+            elif all(event.is_set() for event in ready_events):
+                self.send_response(200)
+            else:
+                self.send_response(503)
+            self.end_headers()
+
+        def do_POST(self):
+            if self.path != webhook_path:
+                self.send_response(404)
+                self.end_headers()
+                return
+            received_token = self.headers.get(
+                'X-Telegram-Bot-Api-Secret-Token', ''
+            )
+            if secret_token and not hmac.compare_digest(
+                received_token.encode(), secret_token.encode()
+            ):
+                self.send_response(403)
+                self.end_headers()
+                return
+            try:
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                chat_id = get_chat_id(json.loads(body))
+            except (ValueError, KeyError, TypeError, AttributeError):
+                logger.warning('Не удалось разобрать апдейт')
+                self.send_response(400)
+                self.end_headers()
+                return
+            shard = get_shard(chat_id, len(worker_queues))
+            worker_queue = worker_queues[shard]
+            try:
+                worker_queue.put(body, timeout=put_timeout)
+            except queue.Full:
+                logger.warning('Очередь воркера %s переполнена', shard)
+                self.send_response(503)
+            else:
+                self.send_response(200)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return WebhookHandler
+
+
+def set_webhook_when_ready(webhook_url, max_connections, ready_events,
+                           secret_token=None):
+    for ready_event in ready_events:
+        ready_event.wait()
+    Bot(os.getenv('TG_TOKEN')).set_webhook(
+        webhook_url,
+        max_connections=max_connections,
+        secret_token=secret_token
+    )
+    logger.info('Воркеры прогреты, вебхук установлен')
+
+
+def main():
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    webhook_url = os.environ['WEBHOOK_URL']
+    listen = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+    port = int(os.getenv('WEBHOOK_PORT', 8443))
+    workers_count = int(os.getenv('WEBHOOK_WORKERS', os.cpu_count()))
+    queue_size = int(os.getenv('WEBHOOK_QUEUE_SIZE', 100))
+    lanes_count = int(os.getenv('BOT_WORKERS', 4))
+    secret_token = os.getenv('WEBHOOK_SECRET_TOKEN')
+
+    worker_queues = []
+    ready_events = []
+    for worker_index in range(workers_count):
+        worker_queue = multiprocessing.Queue(maxsize=queue_size)
+        ready_event = multiprocessing.Event()
+        multiprocessing.Process(
+            target=run_worker,
+            args=(
+                worker_index, worker_queue, lanes_count, queue_size,
+                ready_event
+            ),
+            daemon=True
+        ).start()
+        worker_queues.append(worker_queue)
+        ready_events.append(ready_event)
+
+    request_handler = make_request_handler(
+        urlparse(webhook_url).path or '/',
+        worker_queues,
+        put_timeout=1,
+        ready_events=ready_events,
+        secret_token=secret_token
+    )
+    if os.getenv('MOLTIN_EVENTS_PORT'):
+        start_events_server(
+            int(os.getenv('MOLTIN_EVENTS_PORT')),
+            connect_redis(),
+            os.getenv('MOLTIN_EVENTS_SECRET')
+        )
+    threading.Thread(
+        target=set_webhook_when_ready,
+        args=(
+            webhook_url, workers_count * lanes_count, ready_events,
+            secret_token
+        ),
+        daemon=True
+    ).start()
+    ThreadingHTTPServer((listen, port), request_handler).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,51 @@
 import requests
 
+from breakers import get_breaker
+from deadlines import get_timeout
+from metrics import UPSTREAM_REQUEST_SECONDS, timed
+
+YANDEX_GEOCODER_URL = 'https://geocode-maps.yandex.ru/1.x'
+YANDEX_TIMEOUT = (3.05, 5)
+
 
 def fetch_coordinates(apikey, address):
-    base_url = "https://geocode-maps.yandex.ru/1.x"
-    response = requests.get(base_url, params={
+    base_url = YANDEX_GEOCODER_URL
+    with get_breaker('yandex').guard(), timed(
+        UPSTREAM_REQUEST_SECONDS,
+        upstream='yandex',
+        endpoint='geocode',
+        status=None
+    ) as labels:
+        response = requests.get(base_url, params={
+            "geocode": address,
+            "apikey": apikey,
+            "format": "json",
+        }, timeout=get_timeout(YANDEX_TIMEOUT))
+        labels['status'] = response.status_code
+        response.raise_for_status()
+    return parse_coordinates(response.json())
+
+
+async def fetch_coordinates_async(http_session, apikey, address):
+    import aiohttp
+
+    params = {
         "geocode": address,
         "apikey": apikey,
         "format": "json",
-    })
-    response.raise_for_status()
-    found_places = response.json()['response']['GeoObjectCollection']['featureMember']
+    }
+    timeout = aiohttp.ClientTimeout(total=sum(YANDEX_TIMEOUT))
+    with get_breaker('yandex').guard():
+        async with http_session.get(
+            YANDEX_GEOCODER_URL, params=params, timeout=timeout
+        ) as response:
+            response.raise_for_status()
+            decoded_response = await response.json()
+    return parse_coordinates(decoded_response)
+
+
+def parse_coordinates(decoded_response):
+    found_places = decoded_response['response']['GeoObjectCollection']['featureMember']
     if not found_places:
         return None
 